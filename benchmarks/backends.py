@@ -0,0 +1,309 @@
+"""
+Local stand-ins for the Spotify `tracks` and `audio-features` endpoints and for the Elasticsearch bulk, search and delete endpoints
+Each one answers after `latency` seconds, and every `throttle_every` requests with a 429
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Self
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+def id_number(spotify_id: str) -> int:
+    """Stable number derived from an id, to build the same fake metadata at each run"""
+    return int.from_bytes(hashlib.blake2b(spotify_id.encode(), digest_size=4).digest())
+
+
+def fake_track(track_id: str) -> dict:
+    number = id_number(track_id)
+    return {
+        "id": track_id,
+        "uri": f"spotify:track:{track_id}",
+        "artists": [{"id": f"artist{number % 5_000:018}"}],
+        "album": {"id": f"album{number % 20_000:019}", "album_type": "album", "release_date": f"{1960 + number % 64}-01-01"},
+        "duration_ms": 120_000 + number % 240_000,
+        "popularity": number % 100,
+        "explicit": number % 7 == 0,
+        "is_local": False,
+        "is_playable": True,
+    }
+
+
+def fake_audio_features(track_id: str) -> dict:
+    number = id_number(track_id)
+    return {
+        "id": track_id,
+        "uri": f"spotify:track:{track_id}",
+        "type": "audio_features",
+        "track_href": "",
+        "analysis_url": "",
+        "duration_ms": 120_000 + number % 240_000,
+        "danceability": number % 1000 / 1000,
+        "energy": number % 997 / 997,
+        "key": number % 12,
+        "loudness": -(number % 60),
+        "mode": number % 2,
+        "speechiness": number % 991 / 991,
+        "acousticness": number % 983 / 983,
+        "instrumentalness": number % 977 / 977,
+        "liveness": number % 971 / 971,
+        "valence": number % 967 / 967,
+        "tempo": 60 + number % 140,
+        "time_signature": 4,
+    }
+
+
+class Backend(ABC):
+    """
+    HTTP server running in a daemon thread, to use as a context manager
+    latency: seconds before each answer
+    throttle_every: answer every n requests with a 429, never if 0
+    retry_after: `Retry-After` header of the 429, in seconds
+    """
+
+    def __init__(self, latency: float = 0.0, throttle_every: int = 0, retry_after: float = 1) -> None:
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def __enter__(self) -> Self:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def throttle(self) -> bool:
+        """Count a request, True if it has to be answered with a 429"""
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            throttled = self.throttle_every > 0 and self.requests % self.throttle_every == 0
+            self.throttled += throttled
+        return throttled
+
+    @abstractmethod
+    def answer(self, request: BaseHTTPRequestHandler, method: str) -> tuple[int, dict]:
+        """Status and JSON body of the answer to `request`"""
+
+    def handler(self) -> type[BaseHTTPRequestHandler]:
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: object) -> None:
+                pass
+
+            def respond(self, method: str) -> None:
+                status, body = backend.answer(self, method)
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.send_header("X-Elastic-Product", "Elasticsearch")
+                if status == HTTPStatus.TOO_MANY_REQUESTS:
+                    self.send_header("Retry-After", str(backend.retry_after))
+                self.end_headers()
+                if method != "HEAD":
+                    self.wfile.write(content)
+
+            def do_HEAD(self) -> None:  # noqa: N802
+                self.respond("HEAD")
+
+            def do_GET(self) -> None:  # noqa: N802
+                self.respond("GET")
+
+            def do_POST(self) -> None:  # noqa: N802
+                self.respond("POST")
+
+            def do_PUT(self) -> None:  # noqa: N802
+                self.respond("PUT")
+
+            def do_DELETE(self) -> None:  # noqa: N802
+                self.respond("DELETE")
+
+        return Handler
+
+
+class SpotifyBackend(Backend):
+    """Token, `tracks` and `audio-features` endpoints, ids starting with `unknown` are not found"""
+
+    def answer(self, request: BaseHTTPRequestHandler, method: str) -> tuple[int, dict]:
+        url = urlparse(request.path)
+        if method == "POST":
+            request.rfile.read(int(request.headers.get("Content-Length", 0)))
+            return HTTPStatus.OK, {"access_token": "sploty", "token_type": "Bearer", "expires_in": 3600}
+        if self.throttle():
+            return HTTPStatus.TOO_MANY_REQUESTS, {"error": {"status": 429, "message": "API rate limit exceeded"}}
+        ids = parse_qs(url.query).get("ids", [""])[0].split(",")
+        if url.path.rstrip("/").endswith("audio-features"):
+            return HTTPStatus.OK, {"audio_features": [None if track_id.startswith("unknown") else fake_audio_features(track_id) for track_id in ids]}
+        return HTTPStatus.OK, {"tracks": [None if track_id.startswith("unknown") else fake_track(track_id) for track_id in ids]}
+
+
+class ElasticBackend(Backend):
+    """
+    Bulk, search, scroll and delete endpoints over documents kept in memory by index, with the aliases and settings of the indices,
+    other requests are acknowledged
+    A throttled bulk request rejects each of its documents with a 429
+    template_settings: index settings the index templates give to any new index
+    """
+
+    def __init__(self, latency: float = 0.0, throttle_every: int = 0, retry_after: float = 1, template_settings: dict | None = None) -> None:
+        super().__init__(latency, throttle_every, retry_after)
+        self.documents = 0
+        self.indices: dict[str, dict[str, dict]] = {}
+        self.settings: dict[str, dict] = {}
+        self.aliases: dict[str, set[str]] = {}
+        self.template_settings = template_settings or {}
+        # hits left to return and page size of each open scroll
+        self._scrolls: dict[str, tuple[list[dict], int]] = {}
+
+    def answer(self, request: BaseHTTPRequestHandler, method: str) -> tuple[int, dict]:
+        url = urlparse(request.path)
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        content = request.rfile.read(int(request.headers.get("Content-Length", 0))).decode()
+        if method == "GET" and not parts:
+            return HTTPStatus.OK, {"version": {"number": "8.15.0"}, "tagline": "You Know, for Search"}
+        if parts[-1] == "_bulk":
+            return self.bulk(content.splitlines())
+        if "_search" in parts:
+            return self.search_request(method, parts, query, json.loads(content or "{}"))
+        if method == "DELETE":
+            return self.delete(parts)
+        return self.index_request(method, parts, json.loads(content or "{}"))
+
+    def search_request(self, method: str, parts: list[str], query: dict, body: dict) -> tuple[int, dict]:
+        """First page of a search (`/<index>/_search`), next page or end of a scroll (`/_search/scroll`)"""
+        if parts == ["_search", "scroll"]:
+            scroll_id = body.get("scroll_id", query.get("scroll_id"))
+            return self.next_page(scroll_id) if method != "DELETE" else self.clear_scroll(scroll_id)
+        return self.search(parts[0], int(body.get("size", query.get("size", 10))), scroll="scroll" in query)
+
+    def index_request(self, method: str, parts: list[str], body: dict) -> tuple[int, dict]:
+        """Requests on the aliases and the settings of the indices, the other ones are acknowledged"""
+        if parts[0] in ("_alias", "_aliases"):
+            return self.alias_request(parts, body)
+        if parts[0] == "_index_template" or parts[-1] == "_settings" or (method in ("HEAD", "PUT") and len(parts) == 1):
+            return self.settings_request(method, parts, body)
+        return HTTPStatus.OK, {"acknowledged": True}
+
+    def bulk(self, lines: list[str]) -> tuple[int, dict]:
+        actions = [json.loads(line)["index"] for line in lines[::2]]
+        if self.throttle():
+            items = [{"index": {"_id": action["_id"], "status": 429, "error": {"type": "es_rejected_execution_exception"}}} for action in actions]
+            return HTTPStatus.OK, {"took": 1, "errors": True, "items": items}
+        with self._lock:
+            self.documents += len(actions)
+            for action, source in zip(actions, lines[1::2], strict=True):
+                # an index created by a bulk request gets the settings of the templates
+                self.settings.setdefault(action["_index"], dict(self.template_settings))
+                self.indices.setdefault(action["_index"], {})[action["_id"]] = json.loads(source)
+        items = [{"index": {"_id": action["_id"], "status": 201, "result": "created"}} for action in actions]
+        return HTTPStatus.OK, {"took": 1, "errors": False, "items": items}
+
+    def search(self, index: str, size: int, *, scroll: bool) -> tuple[int, dict]:
+        """First `size` documents of `index` (all of them match), the next ones are kept for the scroll"""
+        if not self.resolve(index):
+            return not_found("index_not_found_exception", index)
+        hits = [{"_index": name, "_id": document_id, "_score": 1.0} for name in self.resolve(index) for document_id in self.indices[name]]
+        body = search_page(hits[:size], len(hits))
+        if scroll:
+            with self._lock:
+                body["_scroll_id"] = f"scroll-{len(self._scrolls)}"
+                self._scrolls[body["_scroll_id"]] = (hits[size:], size)
+        return HTTPStatus.OK, body
+
+    def next_page(self, scroll_id: str) -> tuple[int, dict]:
+        if scroll_id not in self._scrolls:
+            return not_found("search_context_missing_exception", scroll_id)
+        hits, size = self._scrolls[scroll_id]
+        self._scrolls[scroll_id] = (hits[size:], size)
+        return HTTPStatus.OK, search_page(hits[:size], len(hits)) | {"_scroll_id": scroll_id}
+
+    def clear_scroll(self, scroll_id: str) -> tuple[int, dict]:
+        freed = self._scrolls.pop(scroll_id, None) is not None
+        return HTTPStatus.OK, {"succeeded": True, "num_freed": int(freed)}
+
+    def delete(self, parts: list[str]) -> tuple[int, dict]:
+        """Delete an index (`/<index>`) or one of its documents (`/<index>/_doc/<id>`)"""
+        index = parts[0]
+        if index not in self.indices:
+            return not_found("index_not_found_exception", index)
+        if len(parts) == 1:
+            del self.indices[index]
+            self.settings.pop(index, None)
+            for indices in self.aliases.values():
+                indices.discard(index)
+            return HTTPStatus.OK, {"acknowledged": True}
+        document_id = parts[-1]
+        if self.indices[index].pop(document_id, None) is None:
+            return HTTPStatus.NOT_FOUND, {"_index": index, "_id": document_id, "result": "not_found"}
+        return HTTPStatus.OK, {"_index": index, "_id": document_id, "result": "deleted"}
+
+    def resolve(self, name: str) -> list[str]:
+        """Indices of an index or alias name"""
+        return sorted(self.aliases[name]) if self.aliases.get(name) else [name] if name in self.indices else []
+
+    def alias_request(self, parts: list[str], body: dict) -> tuple[int, dict]:
+        """Indices of an alias (`GET /_alias/<alias>`), or atomic update of the aliases (`POST /_aliases`)"""
+        if parts[0] == "_alias":
+            if not self.aliases.get(parts[1]):
+                return HTTPStatus.NOT_FOUND, {"error": f"alias [{parts[1]}] missing", "status": 404}
+            return HTTPStatus.OK, {index: {"aliases": {parts[1]: {}}} for index in self.aliases[parts[1]]}
+        for action in body["actions"]:
+            ((name, target),) = action.items()
+            if name == "add":
+                self.aliases.setdefault(target["alias"], set()).add(target["index"])
+            elif name == "remove":
+                self.aliases.get(target["alias"], set()).discard(target["index"])
+            else:
+                self.delete([target["index"]])
+        return HTTPStatus.OK, {"acknowledged": True}
+
+    def settings_request(self, method: str, parts: list[str], body: dict) -> tuple[int, dict]:
+        """Index existence (`HEAD`), creation (`PUT`), settings (`GET` and `PUT /<index>/_settings`) and simulated template"""
+        if parts[0] == "_index_template":
+            return HTTPStatus.OK, {"template": {"settings": {"index": self.template_settings}, "mappings": {}, "aliases": {}}, "overlapping": []}
+        if method == "PUT" and len(parts) == 1:
+            self.indices[parts[0]] = {}
+            self.settings[parts[0]] = self.template_settings | {name: str(value) for name, value in body.get("settings", {}).items()}
+            return HTTPStatus.OK, {"acknowledged": True, "index": parts[0]}
+        indices = self.resolve(parts[0])
+        if not indices:
+            return not_found("index_not_found_exception", parts[0])
+        if method == "PUT":
+            for index in indices:
+                updated = self.settings[index] | {name: str(value) for name, value in body.items()}
+                self.settings[index] = {name: value for name, value in updated.items() if body.get(name, value) is not None}
+            return HTTPStatus.OK, {"acknowledged": True}
+        return HTTPStatus.OK, {index: {"settings": {"index": self.settings.get(index, {})}} for index in indices}
+
+
+def not_found(error_type: str, name: str) -> tuple[int, dict]:
+    return HTTPStatus.NOT_FOUND, {"error": {"type": error_type, "reason": f"no such index or context [{name}]"}, "status": 404}
+
+
+def search_page(hits: list[dict], total: int) -> dict:
+    shards = {"total": 1, "successful": 1, "skipped": 0, "failed": 0}
+    return {"took": 1, "timed_out": False, "_shards": shards, "hits": {"total": {"value": total, "relation": "eq"}, "hits": hits}}
@@ -0,0 +1,81 @@
+"""
+Compare the memory of the stream frames with text columns stored as strings (before) and as categoricals (schema)
+For the concatenated and the metrics artifacts: size of the frame in memory, and peak memory while the artifact is read
+
+uv run python -m benchmarks.bench_memory --rows 1000000
+"""
+
+from __future__ import annotations
+
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from benchmarks.bench_metrics import synthetic_featured_history
+from benchmarks.generator import generate_history
+from sploty.concat import concat_streams
+from sploty.metrics import compute_metrics
+from sploty.schema import CONCATED_SCHEMA, METRICS_SCHEMA
+from sploty.settings import logger
+from sploty.storage import read_frame, write_frame
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class Arguments(BaseSettings):
+    model_config = SettingsConfigDict(cli_parse_args=True)
+    rows: int = Field(default=1_000_000, description="an optional int")
+
+
+def string_schema(schema: dict[str, str]) -> dict[str, str]:
+    """`schema` with strings instead of categoricals, as before"""
+    return {column: "string" if dtype == "category" else dtype for column, dtype in schema.items()}
+
+
+def frame_mib(df: pd.DataFrame) -> float:
+    return df.memory_usage(deep=True).sum() / 1024 / 1024
+
+
+def read_peak_mib(path: Path, schema: dict[str, str]) -> tuple[pd.DataFrame, float]:
+    """Artifact of `path` read with `schema`, and the peak of the memory allocated to read it"""
+    tracemalloc.start()
+    df = read_frame(path, schema=schema)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return df, peak / 1024 / 1024
+
+
+def compare(path: Path, schema: dict[str, str]) -> None:
+    before, before_peak = read_peak_mib(path, string_schema(schema))
+    after, after_peak = read_peak_mib(path, schema)
+    logger.info(
+        "%s: %.0f MiB in memory before, %.0f MiB after (x%.1f), read peak %.0f MiB before, %.0f MiB after",
+        path.name,
+        frame_mib(before),
+        frame_mib(after),
+        frame_mib(before) / frame_mib(after),
+        before_peak,
+        after_peak,
+    )
+
+
+def main() -> None:
+    args = Arguments()
+    with tempfile.TemporaryDirectory(prefix="sploty_memory_") as folder:
+        generate_history(folder, args.rows)
+        concated_path = Path(folder) / "sploty_concated_history.csv"
+        write_frame(concat_streams(list(Path(folder).glob("Streaming_History_Audio_*.json"))), concated_path, CONCATED_SCHEMA)
+        metrics_path = Path(folder) / "sploty_metrics_history.csv"
+        write_frame(compute_metrics(synthetic_featured_history(args.rows)), metrics_path, METRICS_SCHEMA)
+
+        compare(concated_path, CONCATED_SCHEMA)
+        compare(metrics_path, METRICS_SCHEMA)
+
+
+if __name__ == "__main__":
+    main()
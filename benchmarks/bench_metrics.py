@@ -0,0 +1,153 @@
+"""
+Compare the metrics stage with its previous per-row implementation on a synthetic history
+
+uv run python -m benchmarks.bench_metrics --rows 1000000
+"""
+
+from __future__ import annotations
+
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from pandas import DatetimeIndex
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from sploty.metrics import compute_metrics
+from sploty.schema import FEATURED_SCHEMA, METRICS_SCHEMA, apply_schema
+from sploty.settings import logger
+
+PLATFORMS = [
+    "Android OS 9 API 28 (samsung, SM-G960F)",
+    "iOS 12.1.4 (iPhone8,1)",
+    "OS X 10.14.6 [x86 8]",
+    "Windows 10 (10.0.19041; x64)",
+    "Partner sonos_amlogic Sonos",
+    "web_player windows 10;chrome 87.0.4280.88;desktop",
+    "Partner google cast_tv;Chromecast",
+    "not_applicable",
+]
+
+
+class Arguments(BaseSettings):
+    model_config = SettingsConfigDict(cli_parse_args=True)
+    rows: int = Field(default=1_000_000, description="an optional int")
+    seed: int = Field(default=0, description="an optional int")
+
+
+def synthetic_featured_history(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Featured streaming history with Zipf distributed tracks, sorted by end_time"""
+    rng = np.random.default_rng(seed)
+    seconds = np.sort(rng.integers(0, 10 * 365 * 24 * 60 * 60, rows))
+    end_time = pd.Timestamp("2014-01-01") + pd.to_timedelta(seconds, unit="s")
+    tracks = rng.zipf(1.2, rows) % 50_000
+    df = pd.DataFrame(
+        {
+            "end_time": end_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "platform": rng.choice(PLATFORMS, rows),
+            "ms_played": rng.integers(0, 400_000, rows),
+            "track_uri": [f"track{track:06}" for track in tracks],
+            "artist_uri": [f"artist{track % 5_000:05}" for track in tracks],
+            "album_uri": [f"album{track % 20_000:05}" for track in tracks],
+            "track_duration_ms": 120_000 + tracks % 240_000,
+            "skipped": rng.choice([True, False, None], rows),
+        },
+    )
+    return apply_schema(df, FEATURED_SCHEMA)
+
+
+def legacy_normalize_platform(platform: str):
+    """`metrics.normalize_platform` before it was vectorized, kept as a reference"""
+    normalized = {
+        "android": "Android OS",
+        "partner android_tv": "Android TV",
+        "partner google cast": "Chromecast",
+        "ios": "iOS",
+        "partner ios": "iOS",
+        "osx": "MacOS",
+        "os x": "MacOS",
+        "sonos_": "Sonos",
+        "partner sonos": "Sonos",
+        "partner webos_tv": "WebOS tv",
+        "webplayer": "WebPlayer",
+        "web_player": "WebPlayer",
+        "partner spotify web_player": "WebPlayer",
+        "windows": "Windows",
+        "not_applicable": "not_applicable",
+    }
+    normalized_matches = [value for key, value in normalized.items() if platform.lower().startswith(key.lower())]
+    if len(normalized_matches) > 1:
+        logger.warning(
+            "There are several matches for the `%s` platform: %s (the first one is taken)",
+            platform,
+            normalized_matches,
+        )
+        return normalized_matches[0]
+    if len(normalized_matches) < 1:
+        logger.warning("There is no match for the `%s` platform", platform)
+        return platform
+    return normalized_matches[0]
+
+
+def legacy_compute_metrics(df_stream: pd.DataFrame) -> pd.DataFrame:
+    """Metrics stage as `metrics.main` computed it before it was vectorized, on the history read by `pd.read_csv`, kept as a reference"""
+    df_stream["year"] = DatetimeIndex(df_stream.end_time).year.map(lambda x: f"{x:0>4}")
+    df_stream["month"] = (DatetimeIndex(df_stream.end_time).month).map(lambda x: f"{x:0>2}")
+    df_stream["month_name"] = DatetimeIndex(df_stream.end_time).month_name()
+    df_stream["day"] = DatetimeIndex(df_stream.end_time).day.map(lambda x: f"{x:0>2}")
+    df_stream["day_of_week"] = DatetimeIndex(df_stream.end_time).day_of_week.map(lambda x: f"{x:0>2}")
+    df_stream["day_name"] = DatetimeIndex(df_stream.end_time).day_name()
+    df_stream["hour"] = DatetimeIndex(df_stream.end_time).hour.map(lambda x: f"{x:0>2}")
+    df_stream["minute"] = DatetimeIndex(df_stream.end_time).minute.map(lambda x: f"{x:0>2}")
+    # ":04" writting is fixed in Python 3.10+ : https://stackoverflow.com/a/36044788
+
+    df_stream["min_played"] = df_stream.ms_played / 1000 / 60
+
+    df_stream["percentage_played"] = round((df_stream.ms_played / df_stream.track_duration_ms) * 100, 2)
+    df_stream["percentage_played"] = df_stream["percentage_played"].clip(0, 100)
+
+    df_stream["is_new_track"] = ~df_stream["track_uri"].duplicated(keep="first")
+    df_stream["is_new_artist"] = ~df_stream["artist_uri"].duplicated(keep="first")
+    df_stream["is_new_album"] = ~df_stream["album_uri"].duplicated(keep="first")
+
+    df_stream["normalized_platform"] = df_stream["platform"].apply(legacy_normalize_platform)
+
+    df_stream["skipped"] = df_stream["skipped"].astype(bool)
+
+    return df_stream
+
+
+def timed(func, df: pd.DataFrame) -> tuple[pd.DataFrame, float]:
+    start = time.perf_counter()
+    result = func(df.copy())
+    return result, time.perf_counter() - start
+
+
+def main() -> None:
+    args = Arguments()
+    df = synthetic_featured_history(args.rows, args.seed)
+    logger.info("%i synthetic streams", len(df))
+
+    # the previous implementation read the enriched history from a CSV
+    legacy_input = pd.read_csv(io.StringIO(df.to_csv(index=False)))
+    legacy, legacy_seconds = timed(legacy_compute_metrics, legacy_input)
+    vectorized, vectorized_seconds = timed(compute_metrics, df)
+    legacy = apply_schema(legacy, METRICS_SCHEMA)
+    # the only intended difference: a missing `skipped` was taken for True by `astype(bool)`, it is False since the stage files are typed
+    missing_skipped = df["skipped"].isna().to_numpy()
+    if not legacy.loc[missing_skipped, "skipped"].all():
+        logger.error("the previous implementation did not take a missing skipped for True")
+        sys.exit(1)
+    legacy.loc[missing_skipped, "skipped"] = False
+    pd.testing.assert_frame_equal(legacy, vectorized)
+
+    logger.info("legacy metrics: %.2fs", legacy_seconds)
+    logger.info("vectorized metrics: %.2fs", vectorized_seconds)
+    logger.info("speedup: x%.1f", legacy_seconds / vectorized_seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Check that fetching tracks concurrently is faster than fetching them one request at a time, against the local Spotify stand-in:
+the same tracks are requested serially then with `--concurrency` workers, both runs have to cache the same tracks
+
+uv run python -m benchmarks.check_fetch --tracks 5000 --concurrency 4
+"""
+
+from __future__ import annotations
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urljoin
+
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from benchmarks.backends import SpotifyBackend
+from sploty.fetch_plan import plan_fetches, run_plan
+from sploty.settings import logger
+from sploty.spotify import SpotifyApiParams, SpotifyClient
+from sploty.throttle import TokenBucket
+from sploty.track_cache import TrackCache
+
+
+class Arguments(BaseSettings):
+    model_config = SettingsConfigDict(cli_parse_args=True)
+    tracks: int = Field(default=5_000, description="an optional int")
+    concurrency: int = Field(default=4, description="an optional int")
+    rate: float = Field(default=200, description="an optional float, requests per second of the shared token bucket")
+    latency: float = Field(default=0.05, description="an optional float, in seconds")
+    min_speedup: float = Field(alias="min-speedup", default=2.0, description="an optional float, speedup below which the check fails")
+
+
+def fetch(backend: SpotifyBackend, track_uris: list[str], concurrency: int, rate: float) -> tuple[float, dict]:
+    """Request `track_uris` with `concurrency` workers, return the seconds it took and the cached tracks"""
+    client = SpotifyClient(urljoin(backend.url, "api/token"), "sploty", "sploty", 10, concurrency)
+    params = SpotifyApiParams(
+        base_url=urljoin(backend.url, "v1/"),
+        endpoint="tracks",
+        url=urljoin(backend.url, "v1/tracks/"),
+        client=client,
+        timeout=10,
+        sleep=1,
+        concurrency=concurrency,
+        limiter=TokenBucket(rate, concurrency),
+    )
+    with tempfile.TemporaryDirectory(prefix="sploty_fetch_") as folder:
+        track_cache = TrackCache(Path(folder) / "tracks.sqlite")
+        start = time.perf_counter()
+        run_plan(plan_fetches(track_uris, track_cache), params, None, track_cache)
+        seconds = time.perf_counter() - start
+        tracks = track_cache.get_many(track_uris)
+        track_cache.close()
+    client.close()
+    return seconds, tracks
+
+
+def main() -> None:
+    args = Arguments()
+    track_uris = [f"spotify:track:{number:022}" for number in range(args.tracks)]
+    with SpotifyBackend(args.latency) as backend:
+        serial_seconds, serial_tracks = fetch(backend, track_uris, 1, args.rate)
+        concurrent_seconds, concurrent_tracks = fetch(backend, track_uris, args.concurrency, args.rate)
+
+    speedup = serial_seconds / concurrent_seconds
+    logger.info("serial: %.0f tracks/s (%.1fs)", args.tracks / serial_seconds, serial_seconds)
+    logger.info("%i workers: %.0f tracks/s (%.1fs), %.1fx faster", args.concurrency, args.tracks / concurrent_seconds, concurrent_seconds, speedup)
+    if concurrent_tracks != serial_tracks or len(concurrent_tracks) != args.tracks:
+        logger.error("the concurrent fetch did not cache the same tracks as the serial one")
+        sys.exit(1)
+    if speedup < args.min_speedup:
+        logger.error("the concurrent fetch is less than %.1fx faster than the serial one", args.min_speedup)
+        sys.exit(1)
+    logger.info("the concurrent fetch cached the same tracks %.1fx faster", speedup)
+
+
+if __name__ == "__main__":
+    main()
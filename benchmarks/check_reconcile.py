@@ -0,0 +1,67 @@
+"""
+Check `--elastic-reconcile` against the local Elasticsearch stand-in: streams are indexed with a manifest,
+some of their documents are deleted from the index, reconcile has to forget exactly these ones and the next sync to send them again
+
+uv run python -m benchmarks.check_reconcile --rows 10000 --deleted 100
+"""
+
+from __future__ import annotations
+
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from benchmarks.backends import ElasticBackend
+from benchmarks.bench_metrics import synthetic_featured_history
+from sploty.id_index import hash_ids
+from sploty.index_manifest import IndexManifest, reconcile
+from sploty.metrics import compute_metrics
+from sploty.settings import logger
+from sploty.to_elastic import BulkParams, get_elastic, index_streams
+
+INDEX_NAME = "sploty-reconcile"
+
+
+class Arguments(BaseSettings):
+    model_config = SettingsConfigDict(cli_parse_args=True)
+    rows: int = Field(default=10_000, description="an optional int")
+    deleted: int = Field(default=100, description="an optional int, documents deleted from the index")
+
+
+def main() -> None:
+    args = Arguments()
+    df_metrics = compute_metrics(synthetic_featured_history(args.rows))
+    # ids built like the concat stage does
+    df_metrics["id"] = df_metrics["end_time"].astype(str) + ":" + df_metrics["track_uri"].astype(str)
+    df_metrics = df_metrics.drop_duplicates("id", ignore_index=True)
+    with tempfile.TemporaryDirectory(prefix="sploty_reconcile_") as folder, ElasticBackend() as backend:
+        elastic = get_elastic([backend.url], "sploty", "sploty", 10)
+        bulk_params = BulkParams(manifest_path=str(Path(folder) / "manifest.npz"))
+        index_streams(df_metrics, INDEX_NAME, elastic, bulk_params)
+
+        deleted_ids = pd.Series(np.random.default_rng(0).choice(df_metrics["id"].to_numpy(), args.deleted, replace=False))
+        for document_id in deleted_ids:
+            elastic.delete(index=INDEX_NAME, id=document_id)
+        manifest = IndexManifest.load(bulk_params.manifest_path)
+        reconcile(manifest, elastic, INDEX_NAME)
+        forgotten = len(df_metrics) - len(manifest)
+        still_there = np.isin(hash_ids(deleted_ids), manifest.ids).sum()
+
+        documents = backend.documents
+        index_streams(df_metrics, INDEX_NAME, elastic, bulk_params.model_copy(update={"reconcile": True}))
+        sent_again = backend.documents - documents
+
+    logger.info("%i documents deleted, %i forgotten by reconcile, %i sent again", args.deleted, forgotten, sent_again)
+    if forgotten != args.deleted or still_there or sent_again != args.deleted:
+        logger.error("reconcile did not forget exactly the deleted documents")
+        sys.exit(1)
+    logger.info("reconcile forgot exactly the deleted documents")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Generate a synthetic Spotify extended streaming history
+
+uv run python -m benchmarks.generator --folder /tmp/history --streams 1000000
+"""
+
+from __future__ import annotations
+
+import json
+import string
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from sploty.settings import logger
+
+# streams per file, about the size of the files of a real export
+STREAMS_PER_FILE = 15_000
+BASE62 = np.array(list(string.digits + string.ascii_letters))
+PLATFORMS = [
+    "Android OS 9 API 28 (samsung, SM-G960F)",
+    "iOS 12.1.4 (iPhone8,1)",
+    "OS X 10.14.6 [x86 8]",
+    "Windows 10 (10.0.19041; x64)",
+    "Partner sonos_amlogic Sonos",
+    "web_player windows 10;chrome 87.0.4280.88;desktop",
+    "Partner google cast_tv;Chromecast",
+]
+REASONS_START = ["trackdone", "clickrow", "fwdbtn", "backbtn", "playbtn", "appload"]
+REASONS_END = ["trackdone", "endplay", "fwdbtn", "backbtn", "logout", "unexpected-exit"]
+# share of podcast episodes, of duplicated streams and of streams in shuffle mode
+EPISODE_SHARE = 0.02
+DUPLICATED_SHARE = 0.01
+SHUFFLE_SHARE = 0.5
+
+
+class Arguments(BaseSettings):
+    model_config = SettingsConfigDict(cli_parse_args=True)
+    folder: str = Field(description="a required string")
+    streams: int = Field(default=100_000, description="an optional int")
+    tracks: int | None = Field(default=None, description="an optional int, distinct tracks, streams / 20 by default")
+    seed: int = Field(default=0, description="an optional int")
+
+
+def spotify_ids(count: int, rng: np.random.Generator) -> np.ndarray:
+    """Random base62 ids of 22 characters, like the Spotify ones"""
+    return np.array(["".join(characters) for characters in BASE62[rng.integers(0, len(BASE62), (count, 22))]])
+
+
+def history_file(streams: int, track_ids: np.ndarray, start: pd.Timestamp, rng: np.random.Generator) -> list[dict]:
+    """
+    Streams of one file, after `start`, listening to `track_ids` with a Zipf distribution
+    Some streams are podcast episodes and some are duplicated, as in real exports
+    """
+    end_time = start + pd.to_timedelta(np.cumsum(rng.integers(30, 3 * 60 * 60, streams)), unit="s")
+    ranks = (rng.zipf(1.1, streams) - 1) % len(track_ids)
+    is_episode = rng.random(streams) < EPISODE_SHARE
+    records = [
+        {
+            "ts": ts,
+            "username": "sploty",
+            "platform": platform,
+            "ms_played": int(ms_played),
+            "conn_country": "FR",
+            "ip_addr_decrypted": "127.0.0.1",
+            "user_agent_decrypted": "unknown",
+            "master_metadata_track_name": None if episode else f"Track {track_id[:6]}",
+            "master_metadata_album_artist_name": None if episode else f"Artist {track_id[:3]}",
+            "master_metadata_album_album_name": None if episode else f"Album {track_id[:4]}",
+            "spotify_track_uri": None if episode else f"spotify:track:{track_id}",
+            "episode_name": "Episode" if episode else None,
+            "episode_show_name": "Show" if episode else None,
+            "spotify_episode_uri": f"spotify:episode:{track_id}" if episode else None,
+            "reason_start": reason_start,
+            "reason_end": reason_end,
+            "shuffle": bool(shuffle),
+            "skipped": None if skipped is None else bool(skipped),
+            "offline": False,
+            "offline_timestamp": int(end.timestamp()),
+            "incognito_mode": False,
+        }
+        for ts, end, platform, ms_played, track_id, episode, reason_start, reason_end, shuffle, skipped in zip(
+            end_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            end_time,
+            rng.choice(PLATFORMS, streams),
+            rng.integers(0, 400_000, streams),
+            track_ids[ranks],
+            is_episode,
+            rng.choice(REASONS_START, streams),
+            rng.choice(REASONS_END, streams),
+            rng.random(streams) < SHUFFLE_SHARE,
+            rng.choice([None, True, False], streams),
+            strict=True,
+        )
+    ]
+    duplicated = rng.choice(streams, int(streams * DUPLICATED_SHARE), replace=False)
+    return records + [records[index] for index in duplicated]
+
+
+def generate_history(folder: str | Path, streams: int, tracks: int | None = None, seed: int = 0) -> list[Path]:
+    """
+    Write `streams` synthetic streams in `Streaming_History_Audio_*.json` files of `folder`
+    tracks: distinct tracks listened, streams / 20 by default
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    track_ids = spotify_ids(tracks or max(streams // 20, 1), rng)
+    start = pd.Timestamp("2012-01-01", tz="UTC")
+    paths = []
+    for index, file_start in enumerate(range(0, streams, STREAMS_PER_FILE)):
+        records = history_file(min(STREAMS_PER_FILE, streams - file_start), track_ids, start, rng)
+        start = pd.Timestamp(max(record["ts"] for record in records))
+        path = folder / f"Streaming_History_Audio_{index}.json"
+        path.write_text(json.dumps(records), encoding="UTF-8")
+        paths.append(path)
+    logger.info("%i streams of %i tracks generated in %i files", streams, len(track_ids), len(paths))
+    return paths
+
+
+if __name__ == "__main__":
+    args = Arguments()
+    generate_history(args.folder, args.streams, args.tracks, args.seed)
@@ -0,0 +1,118 @@
+"""
+Time each stage of the pipeline at several scales, against local Spotify and Elasticsearch stand-ins
+Stages slower than the stored baseline are reported as regressions
+
+uv run python -m benchmarks.runner --scales 10000,100000 --save-baseline
+uv run python -m benchmarks.runner --scales 10000,100000
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from benchmarks.backends import ElasticBackend, SpotifyBackend
+from benchmarks.generator import generate_history
+from sploty.settings import logger
+
+ROOT_PATH = Path(__file__).parent.parent
+# differences below this number of seconds are noise, not regressions
+NOISE_SECONDS = 0.1
+
+
+class Arguments(BaseSettings, cli_implicit_flags=True):
+    model_config = SettingsConfigDict(cli_parse_args=True)
+    scales: list[int] = Field(default=[10_000, 100_000], description="numbers of streams, comma separated")
+    baseline: str = Field(default="benchmarks/baseline.json", description="an optional string")
+    save_baseline: bool = Field(alias="save-baseline", default=False, description="store the timings as the new baseline")
+    tolerance: float = Field(default=0.25, description="an optional float, slowdown ratio reported as a regression")
+    spotify_latency: float = Field(alias="spotify-latency", default=0.05, description="an optional float, in seconds")
+    elastic_latency: float = Field(alias="elastic-latency", default=0.01, description="an optional float, in seconds")
+    throttle_every: int = Field(alias="throttle-every", default=50, description="an optional int, requests between two 429")
+
+
+def run_pipeline(folder: Path, spotify: SpotifyBackend, elastic: ElasticBackend) -> dict:
+    """Run the whole pipeline in a new process on the history of `folder`, return its run report"""
+    env = os.environ | {
+        "SPOTIFY_CLIENT_ID": "sploty",
+        "SPOTIFY_CLIENT_SECRET": "sploty",
+        "SPOTIFY_AUTH_URL": f"{spotify.url}api/token",
+        "SPOTIFY_BASE_URL": f"{spotify.url}v1/",
+        "ELASTIC_HOSTS": json.dumps([elastic.url]),
+        "ELASTIC_USER": "sploty",
+        "ELASTIC_PASS": "sploty",
+    }
+    command = [
+        sys.executable,
+        "-m",
+        "sploty.app",
+        "--resources-path",
+        str(folder),
+        "--db-path",
+        str(folder),
+        "--index-name",
+        "sploty-benchmark",
+        "--spotify-sleep",
+        "1",
+    ]
+    subprocess.run(command, env=env, cwd=ROOT_PATH, check=True, capture_output=True)  # noqa: S603
+    return json.loads((folder / "sploty_run_report.json").read_text(encoding="UTF-8"))
+
+
+def benchmark(scale: int, args: Arguments) -> dict[str, float]:
+    """Wall time of each stage for a history of `scale` streams"""
+    with (
+        tempfile.TemporaryDirectory(prefix="sploty_benchmark_") as folder,
+        SpotifyBackend(args.spotify_latency, args.throttle_every) as spotify,
+        ElasticBackend(args.elastic_latency, args.throttle_every) as elastic,
+    ):
+        generate_history(folder, scale)
+        report = run_pipeline(Path(folder), spotify, elastic)
+        logger.info("%i Spotify requests (%i throttled), %i documents indexed", spotify.requests, spotify.throttled, elastic.documents)
+    for stage in report["stages"]:
+        logger.info("%i streams - %s: %.2fs, peak RSS %i MiB", scale, stage["name"], stage["wall_seconds"], stage["peak_rss_mib"])
+    return {stage["name"]: stage["wall_seconds"] for stage in report["stages"]}
+
+
+def regressions(timings: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], tolerance: float) -> list[str]:
+    """Stages slower than the baseline by more than `tolerance`"""
+    slower = []
+    for scale, stages in timings.items():
+        for stage, seconds in stages.items():
+            reference = baseline.get(scale, {}).get(stage)
+            if reference is not None and seconds > reference * (1 + tolerance) and seconds - reference > NOISE_SECONDS:
+                slower.append(f"{stage} at {scale} streams: {seconds:.2f}s instead of {reference:.2f}s")
+    return slower
+
+
+def main() -> None:
+    args = Arguments()
+    timings = {str(scale): benchmark(scale, args) for scale in args.scales}
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline = json.loads(baseline_path.read_text(encoding="UTF-8")) if baseline_path.exists() else {}
+        baseline_path.write_text(json.dumps(baseline | timings, indent=2), encoding="UTF-8")
+        logger.info("baseline saved at %s", baseline_path)
+        return
+    if not baseline_path.exists():
+        logger.warning("no baseline found at %s, run with --save-baseline first", baseline_path)
+        return
+
+    slower = regressions(timings, json.loads(baseline_path.read_text(encoding="UTF-8")), args.tolerance)
+    for regression in slower:
+        logger.error("regression - %s", regression)
+    if slower:
+        sys.exit(1)
+    logger.info("no regression against %s", baseline_path)
+
+
+if __name__ == "__main__":
+    main()
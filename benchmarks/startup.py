@@ -0,0 +1,105 @@
+"""
+Time the startup of the command line: `--help` and a run of the metrics stage only
+Commands slower than the stored baseline are reported as regressions
+
+uv run python -m benchmarks.startup --save-baseline
+uv run python -m benchmarks.startup
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from benchmarks.bench_metrics import synthetic_featured_history
+from benchmarks.runner import ROOT_PATH, regressions
+from sploty.schema import FEATURED_SCHEMA
+from sploty.settings import logger
+from sploty.storage import write_frame
+
+# environment of a run, no request is sent by the metrics stage
+ENVIRONMENT = {
+    "SPOTIFY_CLIENT_ID": "sploty",
+    "SPOTIFY_CLIENT_SECRET": "sploty",
+    "SPOTIFY_AUTH_URL": "http://127.0.0.1/api/token",
+    "SPOTIFY_BASE_URL": "http://127.0.0.1/v1/",
+    "ELASTIC_HOSTS": '["http://127.0.0.1:9200"]',
+    "ELASTIC_USER": "sploty",
+    "ELASTIC_PASS": "sploty",
+}
+# the metrics stage is forced, it would be up to date after the first run
+SKIPPED_STAGES = ["--no-concat", "--no-filter", "--no-enrich", "--no-feature", "--no-elastic", "--force"]
+
+
+class Arguments(BaseSettings, cli_implicit_flags=True):
+    model_config = SettingsConfigDict(cli_parse_args=True)
+    repeat: int = Field(default=5, description="an optional int, runs of each command, the median is kept")
+    rows: int = Field(default=1_000, description="an optional int, streams of the metrics-only run")
+    baseline: str = Field(default="benchmarks/startup_baseline.json", description="an optional string")
+    save_baseline: bool = Field(alias="save-baseline", default=False, description="store the timings as the new baseline")
+    tolerance: float = Field(default=0.25, description="an optional float, slowdown ratio reported as a regression")
+
+
+def import_seconds(arguments: list[str]) -> dict[str, float]:
+    """Cumulative import time of the modules imported by `python -m sploty.app <arguments>`, in seconds"""
+    command = [sys.executable, "-X", "importtime", "-m", "sploty.app", *arguments]
+    result = subprocess.run(command, env=os.environ | ENVIRONMENT, cwd=ROOT_PATH, check=False, capture_output=True, text=True)  # noqa: S603
+    imports = re.findall(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", result.stderr)
+    # only the top level imports, their cumulative time includes the nested ones
+    return {module: int(microseconds) / 1_000_000 for microseconds, indent, module in imports if len(indent) == 1}
+
+
+def wall_seconds(arguments: list[str], repeat: int) -> float:
+    """Median wall time of `python -m sploty.app <arguments>`"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "sploty.app", *arguments], env=os.environ | ENVIRONMENT, cwd=ROOT_PATH, check=True, capture_output=True)  # noqa: S603
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    args = Arguments()
+    with tempfile.TemporaryDirectory(prefix="sploty_startup_") as folder:
+        write_frame(synthetic_featured_history(args.rows), Path(folder) / "sploty_featured_history.csv", FEATURED_SCHEMA)
+        commands = {
+            "help": ["--help"],
+            "metrics-only": ["--resources-path", folder, "--db-path", folder, "--index-name", "sploty-startup", *SKIPPED_STAGES],
+        }
+        timings = {str(args.rows): {name: wall_seconds(arguments, args.repeat) for name, arguments in commands.items()}}
+        for name, arguments in commands.items():
+            imports = import_seconds(arguments)
+            heaviest = sorted(imports, key=imports.get, reverse=True)[:5]
+            heaviest_imports = ", ".join(f"{module} {imports[module]:.2f}s" for module in heaviest)
+            logger.info("%s: %.2fs, heaviest imports %s", name, timings[str(args.rows)][name], heaviest_imports)
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(timings, indent=2), encoding="UTF-8")
+        logger.info("baseline saved at %s", baseline_path)
+        return
+    if not baseline_path.exists():
+        logger.warning("no baseline found at %s, run with --save-baseline first", baseline_path)
+        return
+
+    slower = regressions(timings, json.loads(baseline_path.read_text(encoding="UTF-8")), args.tolerance)
+    for regression in slower:
+        logger.error("regression - %s", regression)
+    if slower:
+        sys.exit(1)
+    logger.info("no regression against %s", baseline_path)
+
+
+if __name__ == "__main__":
+    main()
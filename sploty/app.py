@@ -1,13 +1,25 @@
 from __future__ import annotations
 
+from functools import cached_property
 from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import urljoin
 
 from pydantic import Field, HttpUrl
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-from sploty import audio_features, concat, enrich, filter, metrics, to_elastic
+from sploty import instrumentation
+from sploty.artifacts import STAGES, Stage, StorageFormat, artifact_path, partitioned_path
 from sploty.settings import logger
 
+if TYPE_CHECKING:
+    from sploty.feature_store import FeatureStore
+    from sploty.spotify import SpotifyApiParams, SpotifyClient
+    from sploty.throttle import AdaptiveRateLimiter
+    from sploty.track_cache import TrackCache
+
+# the modules of each stage are imported when the stage runs, so `--help` and partial runs start fast
+
 
 class Arguments(BaseSettings, cli_implicit_flags=True, cli_enforce_required=True):
     model_config = SettingsConfigDict(cli_parse_args=True)
@@ -17,12 +29,62 @@ class Arguments(BaseSettings, cli_implicit_flags=True, cli_enforce_required=True
         default=None,
         description="an optional string",
     )
-    chunk_size: int = Field(alias="chunk-size", default=100, description="an optional int")
+    chunk_size: int = Field(alias="chunk-size", default=100, description="an optional int, tracks enriched between two writes")
+    workers: int = Field(alias="workers", default=1, description="an optional int, processes reading the history files")
+    concat_memory_limit: int | None = Field(
+        alias="concat-memory-limit",
+        default=None,
+        description="an optional int, in MiB, to stream the history files within this memory ceiling",
+    )
     spotify_timeout: int = Field(alias="spotify-timeout", default=10, description="an optional int")
-    spotify_sleep: int = Field(alias="spotify-sleep", default=60, description="an optional int")
+    spotify_sleep: int = Field(alias="spotify-sleep", default=60, description="an optional int, longest wait between two attempts, in seconds")
+    spotify_concurrency: int = Field(alias="spotify-concurrency", default=4, description="an optional int")
+    spotify_rate: float = Field(alias="spotify-rate", default=5, description="an optional float, initial requests per second")
+    spotify_max_rate: float | None = Field(alias="spotify-max-rate", default=None, description="an optional float, requests per second")
+    spotify_tracks_batch_size: int | None = Field(
+        alias="spotify-tracks-batch-size",
+        default=None,
+        description="an optional int, tracks per request, 50 at most",
+    )
+    spotify_features_batch_size: int | None = Field(
+        alias="spotify-features-batch-size",
+        default=None,
+        description="an optional int, audio features per request, 100 at most",
+    )
+    spotify_autotune: bool = Field(alias="spotify-autotune", default=False, description="pick the batch sizes with the most tracks per second")
     db_path: str = Field(alias="db-path", description="a required string")
+    track_cache_ttl: int = Field(alias="track-cache-ttl", default=30, description="an optional int, in days")
+    track_cache_size: int = Field(alias="track-cache-size", default=1_000_000, description="an optional int")
     index_name: str = Field(alias="index-name", description="a required string")
     elastic_timeout: int = Field(alias="elastic-timeout", default=10, description="an optional int")
+    elastic_chunk_size: int = Field(alias="elastic-chunk-size", default=500, description="an optional int, documents per bulk request")
+    elastic_chunk_bytes: int = Field(alias="elastic-chunk-bytes", default=10 * 1024 * 1024, description="an optional int, bytes per bulk request")
+    elastic_threads: int = Field(alias="elastic-threads", default=4, description="an optional int, bulk requests in flight")
+    elastic_max_retries: int = Field(alias="elastic-max-retries", default=3, description="an optional int")
+    elastic_sync: bool = Field(alias="elastic-sync", default=True, description="only send new or changed documents")
+    elastic_reconcile: bool = Field(alias="elastic-reconcile", default=False, description="check the sent documents against the index")
+    elastic_rebuild: bool = Field(alias="elastic-rebuild", default=False, description="index all streams in a new index, then swap the alias")
+    elastic_replicas: int | None = Field(
+        alias="elastic-replicas",
+        default=None,
+        description="an optional int, replicas of a rebuilt index, the ones of the index it replaces by default",
+    )
+    checkpoint_stages: list[Stage] = Field(
+        alias="checkpoint-stages",
+        default=list(STAGES),
+        description="stages whose file is written, comma separated",
+    )
+    profile: bool = Field(alias="profile", default=False, description="dump the cProfile stats of each stage")
+    storage_format: StorageFormat = Field(alias="storage-format", default=StorageFormat.CSV, description="csv, parquet or feather")
+    partitioned: bool = Field(
+        alias="partitioned",
+        default=False,
+        description="store the featured and metrics histories in one file per month, only the months of the new streams are processed",
+    )
+    since: str | None = Field(alias="since", default=None, pattern=r"^\d{4}-\d{2}$", description="an optional string, first month (YYYY-MM) to process")
+    until: str | None = Field(alias="until", default=None, pattern=r"^\d{4}-\d{2}$", description="an optional string, last month (YYYY-MM) to process")
+    force: bool = Field(alias="force", default=False, description="run the stages even when they are up to date")
+    dry_run: bool = Field(alias="dry-run", default=False, description="log the stages that would run, and why, without running them")
     concat: bool = Field(alias="concat", default=True)
     filter: bool = Field(alias="filter", default=True)
     enrich: bool = Field(alias="enrich", default=True)
@@ -42,104 +104,329 @@ class Environment(BaseSettings):
     elastic_pass: str = Field(description="a required string")
 
 
-def main() -> None:
+class SpotifyResources:
+    """
+    Spotify endpoints, track cache and feature store of the enrich and feature stages
+    Each one is imported and opened on first use, so runs skipping these stages do not pay for them
+    """
+
+    def __init__(self, args: Arguments, env: Environment) -> None:
+        self.args = args
+        self.env = env
+
+    @cached_property
+    def client(self) -> SpotifyClient:
+        from sploty.spotify import SpotifyClient
+
+        # the token is only requested by the first Spotify call
+        return SpotifyClient(
+            str(self.env.spotify_auth_url),
+            self.env.spotify_client_id,
+            self.env.spotify_client_secret,
+            self.args.spotify_timeout,
+            self.args.spotify_concurrency,
+        )
+
+    @cached_property
+    def limiter(self) -> AdaptiveRateLimiter:
+        from sploty.throttle import AdaptiveRateLimiter
+
+        return AdaptiveRateLimiter(self.args.spotify_rate, self.args.spotify_concurrency, max_rate=self.args.spotify_max_rate)
+
+    @cached_property
+    def tracks_params(self) -> SpotifyApiParams:
+        from sploty.spotify import SpotifyApiParams
+
+        return SpotifyApiParams(
+            base_url=str(self.env.spotify_base_url),
+            endpoint="tracks",
+            url=urljoin(str(self.env.spotify_base_url), "tracks/"),
+            client=self.client,
+            timeout=self.args.spotify_timeout,
+            sleep=self.args.spotify_sleep,
+            concurrency=self.args.spotify_concurrency,
+            limiter=self.limiter,
+            batch_size=self.args.spotify_tracks_batch_size,
+            autotune=self.args.spotify_autotune,
+        )
+
+    @cached_property
+    def features_params(self) -> SpotifyApiParams:
+        from sploty.spotify import SpotifyApiParams
+
+        return SpotifyApiParams(
+            base_url=str(self.env.spotify_base_url),
+            endpoint="audio-features",
+            url=urljoin(str(self.env.spotify_base_url), "audio-features/"),
+            client=self.client,
+            timeout=self.args.spotify_timeout,
+            sleep=self.args.spotify_sleep,
+            concurrency=self.args.spotify_concurrency,
+            limiter=self.limiter,
+            batch_size=self.args.spotify_features_batch_size,
+            autotune=self.args.spotify_autotune,
+        )
+
+    @cached_property
+    def track_cache(self) -> TrackCache:
+        from sploty.track_cache import TrackCache
+
+        return TrackCache(Path(f"{self.args.db_path}/tracks_metadata.sqlite"), self.args.track_cache_ttl * 24 * 60 * 60, self.args.track_cache_size)
+
+    @cached_property
+    def db(self) -> FeatureStore:
+        from sploty import audio_features
+
+        return audio_features.get_db(Path(f"{self.args.db_path}/tracks.sqlite"), Path(f"{self.args.db_path}/tracks.json"))
+
+    def close(self):
+        """Close what was opened"""
+        for name in ("track_cache", "db", "client"):
+            if name in self.__dict__:
+                self.__dict__[name].close()
+
+
+def main() -> None:  # noqa: PLR0915
     # Parse args and environment vars
     args = Arguments()
     env = Environment()
 
+    from sploty.dag import Dag, Node
+    from sploty.pipeline import Pipeline
+
     # Paths
     resources_path = args.resources_path
     streaming_history_paths = list(Path(resources_path).glob("Streaming_History_Audio_*.json"))
 
-    concated_streaming_history_path = Path(f"{resources_path}/sploty_concated_history.csv")
-    to_enrich_streaming_history_path = Path(f"{resources_path}/sploty_filtered_history.csv")
-    enriched_streaming_history_path = Path(f"{resources_path}/sploty_enriched_history.csv")
-    featured_streaming_history_path = Path(f"{resources_path}/sploty_featured_history.csv")
-    metrics_streaming_history_path = Path(f"{resources_path}/sploty_metrics_history.csv")
+    storage_format = args.storage_format
+    concated_streaming_history_path = artifact_path(resources_path, "sploty_concated_history", storage_format)
+    to_enrich_streaming_history_path = artifact_path(resources_path, "sploty_filtered_history", storage_format)
+    enriched_streaming_history_path = artifact_path(resources_path, "sploty_enriched_history", storage_format)
+    featured_streaming_history_path = (
+        partitioned_path(resources_path, "sploty_featured_history")
+        if args.partitioned
+        else artifact_path(resources_path, "sploty_featured_history", storage_format)
+    )
+    metrics_streaming_history_path = (
+        partitioned_path(resources_path, "sploty_metrics_history")
+        if args.partitioned
+        else artifact_path(resources_path, "sploty_metrics_history", storage_format)
+    )
+    dead_letter_path = f"{resources_path}/sploty_elastic_dead_letter.jsonl"
+    manifest_path = f"{resources_path}/sploty_elastic_{args.index_name}_manifest.npz"
+    run_report_path = f"{resources_path}/sploty_run_report.json"
+    profile_path = f"{resources_path}/sploty_profile"
+    stages_state_path = f"{resources_path}/sploty_stages.json"
+
+    pipeline = Pipeline(
+        {
+            "concated": concated_streaming_history_path,
+            "filtered": to_enrich_streaming_history_path,
+            "enriched": enriched_streaming_history_path,
+            "featured": featured_streaming_history_path,
+            "metrics": metrics_streaming_history_path,
+        },
+        set(args.checkpoint_stages),
+        storage_format if args.partitioned else None,
+        args.since,
+        args.until,
+    )
+    spotify = SpotifyResources(args, env)
 
-    db_path = args.db_path
-    audio_features_db_path = Path(f"{db_path}/tracks.json")
+    # Stages
+    def run_concat() -> None:
+        with instrumentation.stage("concat") as stage:
+            from sploty import concat
 
-    # Process
-    logger.info("============== CONCAT ==============")
-    if args.concat:
-        concat.main(streaming_history_paths, concated_streaming_history_path)
-    else:
-        logger.info("skip")
-    logger.info("============== FILTER ==============")
-    if args.filter:
-        filter.main(
-            concated_streaming_history_path,
-            to_enrich_streaming_history_path,
-            args.previous_enriched_streaming_history_path or enriched_streaming_history_path,
-        )
-    else:
-        logger.info("skip")
-    logger.info("============== ENRICH ==============")
-    if args.enrich:
-        spotify_api_params = enrich.SpotifyApiParams(
-            base_url="https://api.spotify.com/v1/",
-            endpoint="tracks",
-            url="https://api.spotify.com/v1/tracks/",
-            headers=enrich.get_spotify_auth_header(
-                "https://accounts.spotify.com/api/token",
-                env.spotify_client_id,
-                env.spotify_client_secret,
-                args.spotify_timeout,
+            if args.concat_memory_limit is not None:
+                number_of_streams = concat.stream_concat(streaming_history_paths, concated_streaming_history_path, args.concat_memory_limit)
+            else:
+                df_concated = concat.concat_streams(streaming_history_paths, args.workers)
+                number_of_streams = len(df_concated)
+                pipeline.save("concat", df_concated)
+            stage.rows_out = number_of_streams
+
+    def run_filter() -> None:
+        with instrumentation.stage("filter") as stage:
+            from sploty import filter, journal
+            from sploty.id_index import IdIndex
+
+            journal.recover(args.previous_enriched_streaming_history_path or enriched_streaming_history_path)
+            id_index = IdIndex.of_history(args.previous_enriched_streaming_history_path or enriched_streaming_history_path)
+            df_concated = pipeline.load("concat")
+            df_filtered = filter.filter_streams(df_concated, id_index)
+            stage.rows(len(df_concated), len(df_filtered))
+            pipeline.save("filter", df_filtered)
+
+    def run_enrich() -> None:
+        with instrumentation.stage("enrich") as stage:
+            from sploty import enrich, fetch_plan
+
+            appended = "enrich" in pipeline.checkpoint_stages
+            df_filtered = pipeline.load("filter")
+            # the tracks and the audio features of the new streams are requested together, once per unique track
+            plan = fetch_plan.plan_fetches(df_filtered["track_uri"], spotify.track_cache, spotify.db if args.feature else None)
+            fetch_plan.run_plan(plan, spotify.tracks_params, spotify.features_params, spotify.track_cache, spotify.db if args.feature else None)
+            df_enriched = enrich.enrich_streams(
+                df_filtered,
+                args.chunk_size,
+                spotify.tracks_params,
+                spotify.track_cache,
+                enriched_streaming_history_path if appended else None,
+                planned=True,
+            )
+            stage.rows(len(df_filtered), len(df_enriched))
+            pipeline.extend_enriched(df_enriched, appended=appended)
+            spotify.limiter.log_stats()
+
+    def run_feature() -> None:
+        with instrumentation.stage("feature") as stage:
+            from sploty import audio_features
+
+            df_filtered = pipeline.load("filter")
+            df_enriched = pipeline.streams_to_feature(df_filtered)
+            df_featured = audio_features.add_audio_features(
+                df_filtered,
+                df_enriched,
+                args.chunk_size,
+                spotify.features_params,
+                spotify.db,
+                spotify.track_cache,
+            )
+            stage.rows(len(df_enriched), len(df_featured))
+            pipeline.save("feature", df_featured)
+            spotify.limiter.log_stats()
+
+    def run_metric() -> None:
+        with instrumentation.stage("metric") as stage:
+            from sploty import metrics
+
+            df_featured, first_seen = pipeline.streams_to_metric()
+            df_metrics = metrics.compute_metrics(df_featured, first_seen)
+            stage.rows(len(df_featured), len(df_metrics))
+            pipeline.save("metric", df_metrics)
+
+    def run_elastic() -> None:
+        with instrumentation.stage("elastic") as stage:
+            from sploty import elastic_index, to_elastic
+
+            elastic = to_elastic.get_elastic(
+                list(map(str, env.elastic_hosts)),
+                env.elastic_user,
+                env.elastic_pass,
+                args.elastic_timeout,
+            )
+            bulk_params = to_elastic.BulkParams(
+                chunk_size=args.elastic_chunk_size,
+                max_chunk_bytes=args.elastic_chunk_bytes,
+                thread_count=args.elastic_threads,
+                max_retries=args.elastic_max_retries,
+                dead_letter_path=dead_letter_path,
+                manifest_path=manifest_path if args.elastic_sync else None,
+                reconcile=args.elastic_reconcile,
+            )
+            df_metrics = pipeline.streams_to_index(rebuild=args.elastic_rebuild)
+            if args.elastic_rebuild:
+                chunks = to_elastic.iter_chunks(df_metrics, bulk_params.chunk_size)
+                elastic_index.rebuild_index(chunks, args.index_name, elastic, bulk_params, args.elastic_replicas)
+            else:
+                to_elastic.index_streams(df_metrics, args.index_name, elastic, bulk_params)
+            stage.rows(len(df_metrics), instrumentation.run_report.counters["elastic.documents.sent"])
+
+    # months processed by the stages of partitioned artifacts
+    months = {"partitioned": args.partitioned, "since": args.since, "until": args.until}
+    # the enriched history is extended by the enrich stage, it is not an input of the filter stage, which would never be up to date
+    dag = Dag(
+        [
+            Node(
+                name="concat",
+                run=run_concat,
+                inputs=["history"],
+                outputs=["concated"],
+                modules=["sploty.concat"],
+                enabled=args.concat,
+                # the streaming concat always writes its file
+                checkpointed="concat" in pipeline.checkpoint_stages or args.concat_memory_limit is not None,
             ),
-            timeout=args.spotify_timeout,
-            sleep=args.spotify_sleep,
-        )
-        enrich.main(
-            to_enrich_streaming_history_path,
-            enriched_streaming_history_path,
-            args.chunk_size,
-            spotify_api_params,
-        )
-    else:
-        logger.info("skip")
-    logger.info("============= FEATURES =============")
-    if args.feature:
-        db = audio_features.get_db(audio_features_db_path)
-        spotify_api_params = enrich.SpotifyApiParams(
-            base_url="https://api.spotify.com/v1/",
-            endpoint="audio-features",
-            url="https://api.spotify.com/v1/audio-features/",
-            headers=enrich.get_spotify_auth_header(
-                "https://accounts.spotify.com/api/token",
-                env.spotify_client_id,
-                env.spotify_client_secret,
-                args.spotify_timeout,
+            Node(
+                name="filter",
+                run=run_filter,
+                inputs=["concated"],
+                outputs=["filtered"],
+                modules=["sploty.filter", "sploty.id_index"],
+                params={"previous_enriched": args.previous_enriched_streaming_history_path},
+                enabled=args.filter,
+                checkpointed="filter" in pipeline.checkpoint_stages,
             ),
-            timeout=args.spotify_timeout,
-            sleep=args.spotify_sleep,
-        )
-        audio_features.main(
-            to_enrich_streaming_history_path,
-            enriched_streaming_history_path,
-            featured_streaming_history_path,
-            args.chunk_size,
-            spotify_api_params,
-            db,
-        )
-    else:
-        logger.info("skip")
-    logger.info("============== METRICS =============")
-    if args.metric:
-        metrics.main(featured_streaming_history_path, metrics_streaming_history_path)
-    else:
-        logger.info("skip")
-    logger.info("============== ELASTIC =============")
-    if args.elastic:
-        elastic = to_elastic.get_elastic(
-            list(map(str, env.elastic_hosts)),
-            env.elastic_user,
-            env.elastic_pass,
-            args.elastic_timeout,
-        )
-        to_elastic.main(metrics_streaming_history_path, args.index_name, elastic)
-    else:
-        logger.info("skip")
+            Node(
+                name="enrich",
+                run=run_enrich,
+                inputs=["filtered"],
+                outputs=["enriched", "audio_features"],
+                modules=["sploty.enrich", "sploty.fetch_plan", "sploty.spotify"],
+                params={"spotify": str(env.spotify_base_url), "feature": args.feature},
+                enabled=args.enrich,
+                checkpointed="enrich" in pipeline.checkpoint_stages,
+            ),
+            Node(
+                name="feature",
+                run=run_feature,
+                inputs=["filtered", "enriched", "audio_features"],
+                outputs=["featured"],
+                modules=["sploty.audio_features", "sploty.feature_store", "sploty.pipeline"],
+                params=months,
+                enabled=args.feature,
+                checkpointed="feature" in pipeline.checkpoint_stages,
+            ),
+            Node(
+                name="metric",
+                run=run_metric,
+                inputs=["featured"],
+                outputs=["metrics"],
+                modules=["sploty.metrics", "sploty.pipeline"],
+                params=months,
+                enabled=args.metric,
+                checkpointed="metric" in pipeline.checkpoint_stages,
+            ),
+            Node(
+                name="elastic",
+                run=run_elastic,
+                inputs=["metrics"],
+                modules=["sploty.to_elastic", "sploty.elastic_index"],
+                params={
+                    "hosts": list(map(str, env.elastic_hosts)),
+                    "index_name": args.index_name,
+                    "sync": args.elastic_sync,
+                    "rebuild": args.elastic_rebuild,
+                    "replicas": args.elastic_replicas,
+                    **months,
+                },
+                enabled=args.elastic,
+            ),
+        ],
+        {
+            "history": streaming_history_paths,
+            "concated": [concated_streaming_history_path],
+            "filtered": [to_enrich_streaming_history_path],
+            "enriched": [enriched_streaming_history_path],
+            "audio_features": [Path(f"{args.db_path}/tracks.sqlite")],
+            "featured": [featured_streaming_history_path],
+            "metrics": [metrics_streaming_history_path],
+        },
+        stages_state_path,
+        hashed=["history"],
+    )
+    if args.dry_run:
+        logger.info("dry run, nothing is run")
+        dag.log_plan(force=args.force)
+        return
+
+    # Process
+    instrumentation.start_run(run_report_path, profile_path if args.profile else None)
+    try:
+        dag.run(force=args.force)
+    finally:
+        spotify.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,29 @@
+"""Names of the stages and formats of their artifacts, without heavy imports so the command line starts fast"""
+
+from __future__ import annotations
+
+from enum import Enum
+from pathlib import Path
+from typing import Literal
+
+Stage = Literal["concat", "filter", "enrich", "feature", "metric"]
+STAGES: tuple[Stage, ...] = ("concat", "filter", "enrich", "feature", "metric")
+
+
+class StorageFormat(str, Enum):
+    CSV = "csv"
+    PARQUET = "parquet"
+    FEATHER = "feather"
+
+
+def artifact_path(folder: str | Path, name: str, storage_format: StorageFormat) -> Path:
+    return Path(f"{folder}/{name}.{storage_format.value}")
+
+
+def partitioned_path(folder: str | Path, name: str) -> Path:
+    """Folder of the monthly partitions of an artifact, one `<year>-<month>.<format>` file per month"""
+    return Path(f"{folder}/{name}_by_month")
+
+
+def storage_format_of(path: str | Path) -> StorageFormat:
+    return StorageFormat(Path(path).suffix.removeprefix("."))
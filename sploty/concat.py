@@ -1,41 +1,222 @@
+import hashlib
+import heapq
+import json
 import logging
+import re
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import batched, compress
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+from sploty.instrumentation import peak_rss_mib
+from sploty.schema import CONCATED_SCHEMA, apply_schema
+from sploty.storage import append_frame, delete_frame, write_frame
+
 logger = logging.getLogger(__name__)
 
+RENAMED_COLUMNS = {
+    "ts": "end_time",
+    "master_metadata_track_name": "track_name",
+    "master_metadata_album_artist_name": "artist_name",
+    "master_metadata_album_album_name": "album_name",
+}
+DROPPED_COLUMNS = ["spotify_track_uri", "episode_name", "episode_show_name", "spotify_episode_uri"]
+
+# rows written at once by the streaming concat
+WRITE_CHUNK_SIZE = 50_000
+# rows whose fingerprints are checked at once by the streaming concat
+FINGERPRINT_BATCH_SIZE = 10_000
+SEPARATORS = re.compile(r"[\s,]*")
+
+
+def read_streaming_file(input_path: Path) -> pd.DataFrame:
+    """
+    Read and normalise one streaming history file
+    Dropped columns are kept until duplicated rows are removed
+    """
+    df_stream = pd.read_json(input_path)
+    df_stream = df_stream.rename(columns=RENAMED_COLUMNS)
+    # astype(object) because a column without any track is read as float
+    df_stream["track_uri"] = df_stream["spotify_track_uri"].astype(object).str.split(":", n=3).str[2]
+    df_stream["id"] = df_stream.end_time + ":" + df_stream.track_uri
+    return df_stream
+
 
-def main(input_paths: list, concated_path: str):
+def concat_streams(input_paths: list, workers: int = 1) -> pd.DataFrame:
     """
     input_paths: files where read streaming history
-    concated_path: file to write concated streaming history
+    workers: number of processes reading the files
     """
     # Read streaming files
-    df_stream = pd.concat(map(pd.read_json, input_paths))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            df_stream = pd.concat(executor.map(read_streaming_file, input_paths))
+    else:
+        df_stream = pd.concat(map(read_streaming_file, input_paths))
     logger.info("%i rows in %s", len(df_stream), input_paths)
 
     df_stream = df_stream.drop_duplicates()
     logger.info("%i rows without duplicated rows", len(df_stream))
 
-    df_stream = df_stream.rename(
-        columns={
-            "ts": "end_time",
-            "master_metadata_track_name": "track_name",
-            "master_metadata_album_artist_name": "artist_name",
-            "master_metadata_album_album_name": "album_name",
-        },
-    )
-    df_stream["track_uri"] = df_stream["spotify_track_uri"].str.split(":", n=3, expand=True)[2]
-    df_stream = df_stream.drop(
-        ["spotify_track_uri", "episode_name", "episode_show_name", "spotify_episode_uri"],
-        axis=1,
-    )
-
-    df_stream["id"] = df_stream.end_time + ":" + df_stream.track_uri
+    df_stream = df_stream.drop(DROPPED_COLUMNS, axis=1)
 
     df_stream["date"] = pd.to_datetime(df_stream.end_time)
-    df_stream = df_stream.sort_values("date").reset_index(drop=True).drop("date", axis=1)
+    # streams at the same time keep their order, as in `stream_concat`
+    df_stream = df_stream.sort_values("date", kind="stable").reset_index(drop=True).drop("date", axis=1)
+    df_stream = apply_schema(df_stream, CONCATED_SCHEMA)
+    logger.info("peak RSS is %i MiB", peak_rss_mib())
+    return df_stream
+
+
+def iter_json_array(path: Path, buffer_size: int = 1 << 20):
+    """Yield the objects of a JSON array file one by one, reading it `buffer_size` characters at a time"""
+    decoder = json.JSONDecoder()
+    with Path(path).open(encoding="UTF-8") as file:
+        buffer = file.read(buffer_size)
+        position = SEPARATORS.match(buffer).end()
+        if buffer[position : position + 1] != "[":
+            msg = f"{path} is not a JSON array"
+            raise ValueError(msg)
+        position += 1
+        while True:
+            position = SEPARATORS.match(buffer, position).end()
+            if buffer[position : position + 1] == "]":
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                chunk = file.read(buffer_size)
+                if not chunk:
+                    raise
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield record
+
+
+def fingerprint(record: dict) -> int:
+    return int.from_bytes(hashlib.blake2b(json.dumps(record, sort_keys=True).encode(), digest_size=8).digest())
+
+
+class FingerprintSet:
+    """
+    64-bit fingerprints of the streams already read, 8 bytes each
+    They are kept in sorted parts, a part is merged with the previous one once it is as large, so there are few parts to search
+    """
+
+    def __init__(self) -> None:
+        self.parts: list[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return sum(map(len, self.parts))
+
+    def add(self, fingerprints: np.ndarray) -> np.ndarray:
+        """Add `fingerprints`, return the mask of the ones not seen before, the first one of a repeated fingerprint included"""
+        is_new = np.zeros(len(fingerprints), dtype=bool)
+        is_new[np.unique(fingerprints, return_index=True)[1]] = True
+        for part in self.parts:
+            positions = np.searchsorted(part, fingerprints).clip(max=len(part) - 1)
+            is_new &= part[positions] != fingerprints
+        if is_new.any():
+            self.parts.append(np.sort(fingerprints[is_new]))
+        while len(self.parts) > 1 and len(self.parts[-2]) <= len(self.parts[-1]):
+            last_part = self.parts.pop()
+            self.parts[-1] = np.sort(np.concatenate([self.parts[-1], last_part]))
+        return is_new
+
+
+def normalize_record(record: dict) -> dict:
+    """Same transformation as `concat_streams` for a single stream"""
+    stream = {RENAMED_COLUMNS.get(key, key): value for key, value in record.items() if key not in DROPPED_COLUMNS}
+    spotify_track_uri = record.get("spotify_track_uri")
+    stream["track_uri"] = spotify_track_uri.split(":", 3)[2] if spotify_track_uri else None
+    stream["id"] = stream["end_time"] + ":" + stream["track_uri"] if stream["track_uri"] else None
+    return stream
+
+
+def record_size(record: dict) -> int:
+    return sys.getsizeof(record) + sum(map(sys.getsizeof, record.values()))
+
+
+def write_run(streams: list[dict], directory: str) -> Path:
+    """Write sorted streams in a temporary JSON lines file"""
+    streams.sort(key=lambda stream: stream["end_time"])
+    with tempfile.NamedTemporaryFile("w", encoding="UTF-8", dir=directory, suffix=".jsonl", delete=False) as file:
+        file.writelines(json.dumps(stream) + "\n" for stream in streams)
+    return Path(file.name)
+
+
+def read_run(path: Path):
+    with path.open(encoding="UTF-8") as file:
+        for line in file:
+            yield json.loads(line)
+
+
+def stream_concat(input_paths: list, concated_path: str, memory_limit_mib: int) -> int:
+    """
+    Concat streaming history files within a memory ceiling, return the number of streams
+    Duplicated streams are found with 8 bytes fingerprints (see `FingerprintSet`) and streams are sorted with an external merge sort
+    input_paths: files where read streaming history
+    concated_path: file to write concated streaming history
+    memory_limit_mib: memory used by the streams buffered before being sorted and written in a temporary file
+    """
+    memory_limit = memory_limit_mib * 1024 * 1024
+    fingerprints = FingerprintSet()
+    columns = {}
+    number_of_rows = 0
+    with tempfile.TemporaryDirectory(prefix="sploty_concat_") as directory:
+        runs = []
+        buffer, buffer_size = [], 0
+        records = (record for input_path in input_paths for record in iter_json_array(input_path))
+        for batch in batched(records, FINGERPRINT_BATCH_SIZE):
+            number_of_rows += len(batch)
+            is_new = fingerprints.add(np.fromiter(map(fingerprint, batch), dtype=np.uint64, count=len(batch)))
+            for record in compress(batch, is_new):
+                stream = normalize_record(record)
+                columns.update(dict.fromkeys(stream))
+                buffer.append(stream)
+                buffer_size += record_size(stream)
+                if buffer_size >= memory_limit:
+                    runs.append(write_run(buffer, directory))
+                    buffer, buffer_size = [], 0
+        logger.info("%i rows in %s", number_of_rows, input_paths)
+        logger.info("%i rows without duplicated rows", len(fingerprints))
+
+        # sorts and merges are stable, streams at the same time keep their order, as in `concat_streams`
+        if runs:
+            runs.append(write_run(buffer, directory))
+            buffer.clear()
+            streams = heapq.merge(*map(read_run, runs), key=lambda stream: stream["end_time"])
+            logger.info("%i sorted runs merged", len(runs))
+        else:
+            streams = sorted(buffer, key=lambda stream: stream["end_time"])
+
+        # Save stream history
+        delete_frame(concated_path)
+        for chunk in batched(streams, WRITE_CHUNK_SIZE):
+            append_frame(pd.DataFrame.from_records(chunk, columns=list(columns)), concated_path, CONCATED_SCHEMA)
+    logger.info("%i rows are saved at %s", len(fingerprints), concated_path)
+    logger.info("peak RSS is %i MiB", peak_rss_mib())
+    return len(fingerprints)
+
+
+def main(input_paths: list, concated_path: str, memory_limit_mib: int | None = None, workers: int = 1):
+    """
+    input_paths: files where read streaming history
+    concated_path: file to write concated streaming history
+    memory_limit_mib: stream the files within this memory ceiling instead of loading them at once
+    workers: number of processes reading the files, when they are loaded at once
+    """
+    if memory_limit_mib is not None:
+        stream_concat(input_paths, concated_path, memory_limit_mib)
+        return
+
+    df_stream = concat_streams(input_paths, workers)
 
     # Save stream history
-    df_stream.to_csv(concated_path, mode="w", index=False)
+    write_frame(df_stream, concated_path, CONCATED_SCHEMA)
     logger.info("%i rows are saved at %s", len(df_stream), concated_path)
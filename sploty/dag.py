@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+from collections.abc import Callable, Iterable
+from graphlib import TopologicalSorter
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Any
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# bytes read at once to hash the content of a file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def digest(value: Any) -> str:  # noqa: ANN401
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def signature(path: Path) -> str:
+    """Size and modification time of a file or of each part of a folder, cheap to compute"""
+    if not path.exists():
+        return "missing"
+    files = sorted(path.iterdir()) if path.is_dir() else [path]
+    return ";".join(f"{file.name}:{file.stat().st_size}:{file.stat().st_mtime_ns}" for file in files)
+
+
+def content_hash(path: Path) -> str:
+    if not path.exists():
+        return "missing"
+    content = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as file:
+        while block := file.read(HASH_BLOCK_SIZE):
+            content.update(block)
+    return content.hexdigest()
+
+
+def code_version(modules: Iterable[str]) -> str:
+    """Hash of the source of `modules`, found without importing them"""
+    return digest([content_hash(Path(find_spec(module).origin)) for module in modules])
+
+
+class Node(BaseModel):
+    """
+    Stage of the pipeline
+    inputs, outputs: names of the artifacts it reads and writes, a stage runs after the stages writing its inputs
+    modules: modules of the stage, their source is the version of its code
+    params: arguments changing its outputs
+    enabled: False to skip it whatever its inputs (`--no-<stage>`)
+    checkpointed: False when its outputs are only passed in memory, their files are then stale and it always runs
+    """
+
+    name: str
+    run: Callable[[], object]
+    inputs: list[str] = []
+    outputs: list[str] = []
+    modules: list[str] = []
+    params: dict = {}
+    enabled: bool = True
+    checkpointed: bool = True
+
+
+class Dag:
+    """
+    Stages and the artifacts they exchange, stages whose fingerprint (code, params and inputs) did not change
+    since their last run and whose outputs were not modified since are skipped
+    A stage runs again after any stage it depends on, even when the outputs of that one are only passed in memory
+    Stages run one after the other, they share the Spotify session and the SQLite connections opened by the main thread
+    artifacts: files of each artifact, artifacts without file are only passed in memory
+    hashed: artifacts fingerprinted by their content (the inputs not written by a stage), the other ones by their signature
+    state_path: JSON file keeping the fingerprints of the last runs
+    """
+
+    def __init__(self, nodes: list[Node], artifacts: dict[str, list[Path]], state_path: str | Path, hashed: Iterable[str] = ()) -> None:
+        self.nodes = {node.name: node for node in nodes}
+        self.artifacts = artifacts
+        self.hashed = set(hashed)
+        self.state_path = Path(state_path)
+        self.state = json.loads(self.state_path.read_text(encoding="UTF-8")) if self.state_path.exists() else {"stages": {}, "hashes": {}}
+        producers = {output: node.name for node in nodes for output in node.outputs}
+        self.dependencies = {node.name: {producers[name] for name in node.inputs if name in producers} for node in nodes}
+
+    def artifact_fingerprint(self, name: str) -> str:
+        fingerprints = []
+        for path in self.artifacts.get(name, []):
+            if name not in self.hashed:
+                fingerprints.append(signature(path))
+                continue
+            # content hashes are kept with the signature of the file, a file is only hashed again when it changes
+            cached_signature, cached_hash = self.state["hashes"].get(str(path), (None, None))
+            if cached_signature != signature(path):
+                cached_signature, cached_hash = signature(path), content_hash(path)
+                self.state["hashes"][str(path)] = (cached_signature, cached_hash)
+            fingerprints.append(cached_hash)
+        return digest(fingerprints)
+
+    def fingerprint(self, node: Node) -> str:
+        return digest(
+            {
+                "code": code_version(node.modules),
+                "params": node.params,
+                "inputs": {name: self.artifact_fingerprint(name) for name in node.inputs},
+            },
+        )
+
+    def outputs_signature(self, node: Node) -> dict[str, list[str]]:
+        return {name: [signature(path) for path in self.artifacts.get(name, [])] for name in node.outputs}
+
+    def is_up_to_date(self, node: Node) -> bool:
+        """The stage already ran with the same fingerprint and its outputs are untouched"""
+        last_run = self.state["stages"].get(node.name)
+        if last_run is None or last_run["fingerprint"] != self.fingerprint(node):
+            return False
+        outputs = self.outputs_signature(node)
+        return last_run["outputs"] == outputs and "missing" not in str(outputs)
+
+    def decide(self, node: Node, ran: set[str], *, force: bool = False) -> str:
+        """What the stage will do, with its reason, `ran` being the stages that ran before it"""
+        upstream = sorted(self.dependencies[node.name] & ran)
+        if not node.enabled:
+            return "skip (disabled)"
+        if force:
+            return "run (forced)"
+        if upstream:
+            return f"run (after {', '.join(upstream)})"
+        if not node.checkpointed:
+            return "run (outputs only kept in memory)"
+        if not self.is_up_to_date(node):
+            return "run (inputs, code or parameters changed)"
+        return "skip (up to date)"
+
+    def plan(self, *, force: bool = False) -> dict[str, str]:
+        """What each stage will do, with its reason"""
+        decisions = {}
+        ran = set()
+        for name in TopologicalSorter(self.dependencies).static_order():
+            decisions[name] = self.decide(self.nodes[name], ran, force=force)
+            if decisions[name].startswith("run"):
+                ran.add(name)
+        return decisions
+
+    def log_plan(self, *, force: bool = False):
+        for name, decision in self.plan(force=force).items():
+            logger.info("%-8s %s", name, decision)
+
+    def run_node(self, node: Node, ran: set[str], *, force: bool = False):
+        """Run the stage unless `decide` skips it, add it to `ran` if it runs"""
+        logger.info("%s", f" {node.name.upper()} ".center(36, "="))
+        decision = self.decide(node, ran, force=force)
+        logger.info("%s", decision)
+        if not decision.startswith("run"):
+            return
+        fingerprint = self.fingerprint(node)
+        node.run()
+        ran.add(node.name)
+        if node.checkpointed:
+            self.state["stages"][node.name] = {"fingerprint": fingerprint, "outputs": self.outputs_signature(node)}
+        else:
+            # the files left by a previous run are stale, they never make the stage up to date again
+            self.state["stages"].pop(node.name, None)
+        self.save()
+
+    def run(self, *, force: bool = False):
+        """Run the stages in dependency order"""
+        ran = set()
+        for name in TopologicalSorter(self.dependencies).static_order():
+            self.run_node(self.nodes[name], ran, force=force)
+
+    def save(self):
+        tmp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.state, indent=2), encoding="UTF-8")
+        tmp_path.replace(self.state_path)
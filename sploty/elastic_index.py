@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import logging
+import time
+from http import HTTPStatus
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from elasticsearch import ApiError, NotFoundError, TransportError
+
+from sploty.to_elastic import BulkParams, index_chunks
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# to increase each time the `spotify-stream-mapping` component template changes (see elastic/README_ELASTIC.md), it is part of the index names
+MAPPING_VERSION = 1
+# settings lowered while a new index is loaded, then given back the values of the index it replaces
+RESTORED_SETTINGS = ("number_of_replicas", "refresh_interval")
+# statuses of documents rejected because of the cluster, not because of their content
+CLUSTER_ERROR_STATUSES = {HTTPStatus.TOO_MANY_REQUESTS} | {status for status in HTTPStatus if status >= HTTPStatus.INTERNAL_SERVER_ERROR}
+# seconds to wait for the force merge of a freshly loaded index
+FORCE_MERGE_TIMEOUT = 30 * 60
+
+
+def template_settings(elastic, index_name: str) -> dict:
+    """
+    Settings the index templates give to `index_name`, with the mapping and the ingest pipeline renaming the fields of the documents
+    They are the single source of the mapping (see elastic/README_ELASTIC.md), an index no template matches is mapped dynamically
+    """
+    template = elastic.indices.simulate_index_template(name=index_name).get("template", {})
+    if not template.get("mappings"):
+        logger.warning("no index template matches %s, its fields are mapped dynamically (see elastic/README_ELASTIC.md)", index_name)
+    return template.get("settings", {}).get("index", {})
+
+
+def served_settings(elastic, alias: str, index_name: str) -> dict:
+    """
+    Replicas and refresh interval to give back to the new index `index_name` once loaded: the ones of the index served by `alias`,
+    else the ones of its index templates, None (the default of the cluster) for the ones set by neither
+    """
+    try:
+        settings = next(iter(elastic.indices.get_settings(index=alias).values()))["settings"]["index"]
+    except NotFoundError:
+        settings = template_settings(elastic, index_name)
+    return {name: settings.get(name) for name in RESTORED_SETTINGS}
+
+
+def aliased_indices(elastic, alias: str) -> list[str]:
+    try:
+        return list(elastic.indices.get_alias(name=alias))
+    except NotFoundError:
+        return []
+
+
+def swap_alias(elastic, alias: str, index_name: str) -> list[str]:
+    """
+    Point `alias` to `index_name` only, in a single atomic call
+    An index named like the alias (indexed before the alias existed) is removed by the same call
+    Return the indices the alias pointed to
+    """
+    previous_indices = aliased_indices(elastic, alias)
+    actions = [{"remove": {"index": previous_index, "alias": alias}} for previous_index in previous_indices]
+    if not previous_indices and elastic.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": index_name, "alias": alias}})
+    elastic.indices.update_aliases(actions=actions)
+    logger.info("alias %s now points to %s", alias, index_name)
+    return previous_indices
+
+
+def load_index(chunks: Iterable[pd.DataFrame], index_name: str, elastic, bulk_params: BulkParams, settings: dict):
+    """Index all streams in a new index, then restore its replicas and refresh interval (`settings`), refresh it and merge its segments"""
+    failed_statuses = index_chunks(chunks, index_name, elastic, bulk_params.model_copy(update={"reconcile": False}))
+    cluster_errors = sum(count for status, count in failed_statuses.items() if status in CLUSTER_ERROR_STATUSES)
+    if cluster_errors:
+        msg = f"{cluster_errors} documents were rejected by the cluster"
+        raise RuntimeError(msg)
+    elastic.indices.put_settings(index=index_name, settings=settings)
+    elastic.indices.refresh(index=index_name)
+    elastic.options(request_timeout=FORCE_MERGE_TIMEOUT).indices.forcemerge(index=index_name, max_num_segments=1)
+    logger.info("index %s loaded and merged", index_name)
+
+
+def rebuild_index(chunks: Iterable[pd.DataFrame], alias: str, elastic, bulk_params: BulkParams, replicas: int | None = None) -> str:
+    """
+    Index all streams in a new index, mapped by the index templates, then swap `alias` to it
+    The new index is loaded without replicas nor refresh, they are restored before the swap to the values of the previous index,
+    `replicas` overrides its number of replicas
+    The alias serves the previous index until then, so a half-built index is never searched
+    Return the name of the new index
+    """
+    index_name = f"{alias}-v{MAPPING_VERSION}-{time.strftime('%Y%m%d%H%M%S')}"
+    settings = served_settings(elastic, alias, index_name)
+    if replicas is not None:
+        settings["number_of_replicas"] = replicas
+    elastic.indices.create(index=index_name, settings={"number_of_replicas": 0, "refresh_interval": "-1"})
+    logger.info("index %s created, %s once loaded", index_name, settings)
+
+    # every document goes to the new index, the manifest of the previous one is obsolete
+    if bulk_params.manifest_path is not None:
+        Path(bulk_params.manifest_path).unlink(missing_ok=True)
+    try:
+        load_index(chunks, index_name, elastic, bulk_params, settings)
+    except Exception:
+        logger.exception("rebuild of %s failed, %s is left untouched", index_name, alias)
+        elastic.indices.delete(index=index_name)
+        if bulk_params.manifest_path is not None:
+            Path(bulk_params.manifest_path).unlink(missing_ok=True)
+        raise
+
+    # the rebuild is done once the alias is swapped, a previous index left behind only takes space
+    for previous_index in swap_alias(elastic, alias, index_name):
+        try:
+            elastic.indices.delete(index=previous_index)
+        except (ApiError, TransportError) as error:
+            logger.warning("previous index %s could not be deleted, delete it by hand: %s", previous_index, error)
+        else:
+            logger.info("previous index %s deleted", previous_index)
+    return index_name
@@ -1,192 +1,228 @@
 import logging
-import time
-from http import HTTPStatus
-from itertools import batched
-from pathlib import Path
+from itertools import batched, chain
 
 import numpy as np
 import pandas as pd
-import requests
-from pydantic import BaseModel, HttpUrl
-from requests.exceptions import ConnectionError, HTTPError
 
+from sploty.id_index import IdIndex, id_index_path
+from sploty.journal import EnrichJournal, journal_path, recover
+from sploty.schema import CONCATED_SCHEMA, ENRICHED_SCHEMA, apply_schema
 from sploty.settings import BoldColor
+from sploty.spotify import SpotifyApiParams, get_many, spotify_batches
+from sploty.storage import append_frame, append_mark, read_frame, sync_frame
+from sploty.throttle import TokenBucket, ordered_map
+from sploty.track_cache import TrackCache
 
 logger = logging.getLogger(__name__)
 
 
-class SpotifyApiParams(BaseModel):
-    base_url: str
-    endpoint: str
-    url: HttpUrl
-    headers: dict
-    timeout: float
-    sleep: float
-    connection_error_retry: int = 5
-
-
-def do_spotify_request(spotify_api_params: SpotifyApiParams, params=None, retry=0):
-    try:
-        response = requests.get(
-            spotify_api_params.url,
-            headers=spotify_api_params.headers,
-            params=params,
-            timeout=spotify_api_params.timeout,
-        )
-        logger.debug(" -> %s", response.request.url)
-        logger.debug(" <- %i %s", response.status_code, response.text[:200].replace(" ", "").encode("UTF-8"))
-        response.raise_for_status()
-        return response.json()
-    except HTTPError as err:
-        if err.response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
-            logger.warning("HTTPError - %s (sleeping %is...)", err, spotify_api_params.sleep)
-            time.sleep(spotify_api_params.sleep)
-            return do_spotify_request(spotify_api_params, params)
-        logger.warning("HTTPError - %s (skipping)", err)
-        raise
-    except ConnectionError as err:
-        if retry < spotify_api_params.connection_error_retry:
-            logger.warning(
-                "ConnectionError - %s (retry %i/5 sleeping %is...)",
-                err,
-                retry + 1,
-                spotify_api_params.sleep,
-            )
-            time.sleep(spotify_api_params.sleep * (retry + 1))
-            return do_spotify_request(spotify_api_params, params, retry + 1)
-        logger.warning("ConnectionError - %s (skipping)", err)
-        raise
-
-
 def another_get(spotify_api_params: SpotifyApiParams, track_uris):
-    params = [("ids", ",".join(track_uris)), ("type", "track"), ("market", "FR")]
-    return do_spotify_request(spotify_api_params, params=params)
-
-
-def merger(df1, df5):
-    df1["is_done"] = df1.track_uri.isin(df5.track_uri)
-    df = df1.merge(df5, on="track_uri", how="left")
-
-    for c_x in df.columns:
-        if c_x.endswith("_x"):
-            c = c_x.removesuffix("_x")
-            c_y = c + "_y"
-            df[c] = df[c_y].where(df.is_done, df[c_x])
-    return df.loc[:, ~df.columns.str.contains("_x$|_y$")]
-
+    return get_many(spotify_api_params, track_uris, "tracks")
+
+
+# track metadata columns of the enriched streams, from the fields of the API track objects
+TRACK_FIELDS = {
+    "artist_uri": "artists",
+    "track_duration_ms": "duration_ms",
+    "track_popularity": "popularity",
+    "track_is_explicit": "explicit",
+    "track_is_local": "is_local",
+    "track_is_playable": "is_playable",
+    "album_uri": "album.id",
+    "album_type": "album.album_type",
+    "album_release_date": "album.release_date",
+}
+# stream columns written after the track metadata in the enriched files
+TRAILING_COLUMNS = ["ms_played", "track_name", "artist_name"]
+
+
+def tracks_table(track_uris: list[str], tracks: list[dict | None]) -> pd.DataFrame:
+    """
+    One row of metadata per requested track, tracks not found by the API are left out
+    track_uris: requested ids, the API can answer with another (relinked) track
+    """
+    found = [(track_uri, track) for track_uri, track in zip(track_uris, tracks, strict=True) if track is not None]
+    df_track = pd.json_normalize([track for _, track in found]).reindex(columns=list(TRACK_FIELDS.values()))
+    df_track.columns = list(TRACK_FIELDS)
+    df_track["artist_uri"] = df_track["artist_uri"].astype(object).str[0].str["id"]  # only one artist :(
+    df_track["track_duration_ms"] = df_track["track_duration_ms"].where(df_track["track_duration_ms"] != 0)
+    df_track.insert(0, "track_uri", [track_uri for track_uri, _ in found])
+    return df_track
 
-def saver(df_tableau, complete_data, enriched_path):
-    complete_data = pd.DataFrame.from_dict(complete_data, orient="index")
 
-    if len(complete_data) == 0:
-        return df_tableau
+def join_tracks(df_stream: pd.DataFrame, df_track: pd.DataFrame) -> pd.DataFrame:
+    """Streams of `df_stream` whose track is in `df_track`, with its metadata, in the column order of the enriched files"""
+    df = df_stream.merge(df_track, on="track_uri", how="inner")
+    df["is_done"] = True
+    leading_columns = [column for column in df_stream.columns if column not in TRAILING_COLUMNS]
+    trailing_columns = [column for column in df_stream.columns if column in TRAILING_COLUMNS]
+    return df[[*leading_columns, "is_done", *TRACK_FIELDS, *trailing_columns]]
 
-    streams = merger(df_tableau, complete_data)
-    to_write = streams[streams["is_done"] == True]  # noqa: E712
-    to_keep = streams[streams["is_done"] == False]  # noqa: E712
-    # == to prevent "KeyError: False"
 
-    # writes data in csv file
-    to_write.to_csv(
-        enriched_path,
-        mode="a",
-        header=not Path(enriched_path).exists(),
-        index=False,
+def log_progress(checkpoint: int, target: int, limiter: TokenBucket | None):
+    logger.info(
+        BoldColor.PURPLE  # noqa: G003
+        + "["
+        + ("-" * int(checkpoint * 60 / target)).ljust(60, " ")
+        + "]"
+        + BoldColor.DARKCYAN
+        + f" {checkpoint}/{target}"
+        + (f" at {limiter.rate:.1f} requests/s" if limiter else "")
+        + BoldColor.END,
     )
+    # logger.info(f'{" "*40}{BoldColor.PURPLE}[{"-"*int(checkpoint / step)}{" "* int((target - checkpoint) / step)}]{BoldColor.DARKCYAN} {checkpoint}/{target}{BoldColor.END}') #noqa: ERA001, E501
 
-    return to_keep.reset_index(drop=True)
 
+def cache_tracks(track_cache: TrackCache, tracks: dict[str, dict | None]):
+    """Store the requested `tracks` in `track_cache`, the ones Spotify answered with null as missing"""
+    track_cache.put_many({track_uri: track for track_uri, track in tracks.items() if track is not None})
+    track_cache.put_missing("tracks", [track_uri for track_uri, track in tracks.items() if track is None])
 
-def better_enrich(df_tableau, chunk_size, enriched_path, spotify_api_params):
-    logger.info("enrich track data for %i tracks", len(df_tableau))
 
-    df = df_tableau[["track_uri", "track_name", "artist_name", "ms_played"]].drop_duplicates(
-        "track_uri",
-    )
-    logger.info("reduce enrich for only %i tracks", len(df))
+def known_tracks(track_uris: pd.Series, track_cache: TrackCache | None, journal: EnrichJournal | None, *, planned: bool) -> dict[str, dict | None]:
+    """
+    Responses already known of `track_uris`: cached tracks, tracks Spotify does not know and responses of an interrupted run
+    The cache hits and misses are counted here unless `fetch_plan.run_plan` requested the tracks before
+    """
+    cached_tracks = track_cache.get_known(track_uris) if track_cache is not None else {}
+    if journal is not None:
+        cached_tracks |= journal.tracks()
+    is_cached = track_uris.isin(cached_tracks)
+    logger.info("%i tracks found in cache, %i tracks to request", is_cached.sum(), (~is_cached).sum())
+    if track_cache is not None and not planned:
+        track_cache.count_lookups(int(is_cached.sum()), int((~is_cached).sum()))
+    return cached_tracks
+
+
+def better_enrich(  # noqa: PLR0913
+    df_tableau,
+    chunk_size,
+    enriched_path,
+    spotify_api_params,
+    track_cache: TrackCache | None = None,
+    journal: EnrichJournal | None = None,
+    *,
+    planned: bool = False,
+) -> pd.DataFrame:
+    """
+    Return the enriched streams of `df_tableau`, streams whose track Spotify answers with null are left out
+    They are also appended to `enriched_path` every `chunk_size` tracks if it is given, each chunk committed in `journal`
+    Tracks are requested by batches of the size of the endpoint (see `spotify_batches`)
+    planned: the tracks were already requested by `fetch_plan.run_plan`, which counted the cache hits and misses
+    """
+    logger.info("enrich track data for %i tracks", len(df_tableau))
 
-    dict_all = {}
-    target = len(df)
+    # positions of the streams of each track, in history order
+    streams_of_track = df_tableau.groupby("track_uri", sort=False, observed=True).indices
+    track_uris = pd.Series(list(streams_of_track), dtype=object)
+    logger.info("reduce enrich for only %i tracks", len(track_uris))
+
+    cached_tracks = known_tracks(track_uris, track_cache, journal, planned=planned)
+    is_cached = track_uris.isin(cached_tracks)
+
+    def fetch(batch) -> list:
+        return another_get(spotify_api_params, batch)
+
+    cached_batches = ((batch, [cached_tracks[track_uri] for track_uri in batch]) for batch in batched(track_uris[is_cached], chunk_size))
+    fetched_batches = ordered_map(fetch, spotify_batches(spotify_api_params, track_uris[~is_cached]), spotify_api_params.concurrency)
+
+    enriched_chunks = []
+
+    def flush(chunk_uris: list[str], chunk_tracks: list) -> None:
+        # only the streams of the tracks of this chunk are joined, the pending streams are never rescanned
+        positions = np.sort(np.concatenate([streams_of_track[track_uri] for track_uri in chunk_uris]))
+        df_chunk = df_tableau.take(positions)
+        enriched_chunk = apply_schema(join_tracks(df_chunk, tracks_table(chunk_uris, chunk_tracks)), ENRICHED_SCHEMA)
+        if enriched_path is not None:
+            append_frame(enriched_chunk, enriched_path)
+            if journal is not None:
+                sync_frame(enriched_path)
+                # the streams left out are committed too, a resumed run does not select them again
+                journal.commit(chunk_uris, chunk_tracks, df_chunk["id"], append_mark(enriched_path))
+        enriched_chunks.append(enriched_chunk)
+
+    chunk_uris, chunk_tracks = [], []
+    target = len(track_uris)
     checkpoint = 0
-    for rows in batched(df.iterrows(), chunk_size):
-        logger.info(
-            BoldColor.PURPLE  # noqa: G003
-            + "["
-            + ("-" * int(checkpoint * 60 / target)).ljust(60, " ")
-            + "]"
-            + BoldColor.DARKCYAN
-            + f" {checkpoint}/{target}"
-            + BoldColor.END,
-        )
-        # logger.info(f'{" "*40}{BoldColor.PURPLE}[{"-"*int(checkpoint / step)}{" "* int((target - checkpoint) / step)}]{BoldColor.DARKCYAN} {checkpoint}/{target}{BoldColor.END}') #noqa: ERA001, E501
-        response = another_get(spotify_api_params, [row[1]["track_uri"] for row in rows])  # il doit y avoir mieux
-        for i, row in enumerate(rows):
-            index = row[0]
-            stream = row[1]
-
-            track = response["tracks"][i]
-            artist = track["artists"][0]  # only one artist :(
-            album = track["album"]
-            track_uri = track["uri"]
-
-            logger.debug("enrich track uri n°%i (%s)", index, track_uri)
-
-            stream["artist_uri"] = artist["id"]
-            stream["track_duration_ms"] = (
-                track.get("duration_ms", np.nan) if track.get("duration_ms", None) != 0.0 else np.nan
-            )
-            stream["track_popularity"] = track.get("popularity", None)
-            stream["track_is_explicit"] = track["explicit"]
-            stream["track_is_local"] = track["is_local"]
-            stream["track_is_playable"] = track["is_playable"]
-            stream["album_uri"] = album["id"]
-            stream["album_type"] = album["album_type"]
-            stream["album_release_date"] = album["release_date"]
-            dict_all[index] = stream
-        checkpoint += chunk_size
-        df_tableau = saver(df_tableau, dict_all, enriched_path)
-        dict_all = {}
-
-
-def number_of_lines(file_path: str):
-    fp = Path(file_path)
-    if fp.exists():
-        with fp.open(encoding="UTF-8") as file:
-            return sum(1 for _ in file) - 1
-    return 0
-
-
-def main(to_enrich_path: list, enriched_path: str, chunk_size: int, spotify_api_params: SpotifyApiParams):
+    for batch, tracks in chain(cached_batches, fetched_batches):
+        log_progress(checkpoint, target, spotify_api_params.limiter)
+        if track_cache is not None:
+            cache_tracks(track_cache, {track_uri: track for track_uri, track in zip(batch, tracks, strict=True) if track_uri not in cached_tracks})
+        checkpoint += len(batch)
+
+        chunk_uris.extend(batch)
+        chunk_tracks.extend(tracks)
+        if len(chunk_uris) >= chunk_size:
+            flush(chunk_uris, chunk_tracks)
+            chunk_uris, chunk_tracks = [], []
+    if chunk_uris:
+        flush(chunk_uris, chunk_tracks)
+    df_enriched = pd.concat(enriched_chunks, ignore_index=True) if enriched_chunks else df_tableau.iloc[:0]
+    if len(df_enriched) < len(df_tableau):
+        logger.warning("%i streams left out, Spotify does not know their track", len(df_tableau) - len(df_enriched))
+    return df_enriched
+
+
+def enrich_streams(  # noqa: PLR0913
+    df_stream: pd.DataFrame,
+    chunk_size: int,
+    spotify_api_params: SpotifyApiParams,
+    track_cache: TrackCache | None = None,
+    enriched_path: str | None = None,
+    *,
+    planned: bool = False,
+) -> pd.DataFrame:
+    """
+    df_stream: filtered streaming history
+    chunk_size: tracks enriched between two writes of `enriched_path`
+    track_cache: cache of already requested tracks
+    enriched_path: file where append enriched streams as soon as they are enriched
+    planned: the tracks were already requested by `fetch_plan.run_plan`
+    """
+    logger.info("%i rows to enrich", len(df_stream))
+
+    journal = None
+    id_index = None
+    if enriched_path is not None:
+        # an interrupted run is resumed from its last committed batch
+        recover(enriched_path)
+        # the index is loaded before the enriched file is appended, while it is still up to date
+        id_index = IdIndex.of_history(enriched_path)
+        journal = EnrichJournal(journal_path(enriched_path))
+        if id_index is not None:
+            # streams already enriched, by an interrupted run or when the stage runs again on the same filtered streams, are left out
+            df_stream = df_stream[~id_index.contains(df_stream["id"])].reset_index(drop=True)
+            logger.info("%i rows left to enrich after the already enriched streams", len(df_stream))
+        journal.start(enriched_path)
+
+    df_enriched = better_enrich(df_stream, chunk_size, enriched_path, spotify_api_params, track_cache, journal, planned=planned)
+    if track_cache is not None:
+        track_cache.log_stats()
+
+    if enriched_path is not None:
+        # the streams left out by `better_enrich` are indexed too, so that the next runs do not select them again
+        id_index = id_index if id_index is not None else IdIndex.from_ids(df_stream["id"])
+        id_index.add(df_stream["id"])
+        id_index.save(id_index_path(enriched_path))
+        journal.close()
+
+    logger.info("%i tracks enriched / %i rows to enrich", len(df_enriched), len(df_stream))
+    return df_enriched
+
+
+def main(
+    to_enrich_path: list,
+    enriched_path: str,
+    chunk_size: int,
+    spotify_api_params: SpotifyApiParams,
+    track_cache: TrackCache | None = None,
+):
     """
     to_enrich_path: file where read filtered streaming history
     enriched_path: file where already enriched streaming history
     chunk_size:
+    track_cache: cache of already requested tracks
     """
     # enriches the data tracks and indexes it
-    df_stream = pd.read_csv(to_enrich_path)
-    logger.info("%i rows to enrich", len(df_stream))
-
-    old_number_of_enriched_streams = number_of_lines(enriched_path)
-
-    better_enrich(df_stream, chunk_size, enriched_path, spotify_api_params)
-
-    new_number_of_enriched_streams = number_of_lines(enriched_path)
-    logger.info(
-        "%i tracks enriched / %i rows to enrich",
-        new_number_of_enriched_streams - old_number_of_enriched_streams,
-        len(df_stream),
-    )
-
-
-def get_spotify_auth_header(auth_url, client_id, client_secret, timeout):
-    auth_response = requests.post(
-        auth_url,
-        {
-            "grant_type": "client_credentials",
-            "client_id": client_id,
-            "client_secret": client_secret,
-        },
-        timeout=timeout,
-    )
-    auth_response_data = auth_response.json()
-    return {"Authorization": f"Bearer {auth_response_data['access_token']}"}
+    df_stream = read_frame(to_enrich_path, schema=CONCATED_SCHEMA)
+    enrich_streams(df_stream, chunk_size, spotify_api_params, track_cache, enriched_path)
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from itertools import batched
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pandas as pd
+from tinydb import TinyDB
+
+from sploty.track_cache import SQLITE_MAX_VARIABLES
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+logger = logging.getLogger(__name__)
+
+# columns of the Spotify `audio-features` objects
+AUDIO_FEATURE_COLUMNS = {
+    "id": "TEXT PRIMARY KEY",
+    "danceability": "REAL",
+    "energy": "REAL",
+    "key": "INTEGER",
+    "loudness": "REAL",
+    "mode": "INTEGER",
+    "speechiness": "REAL",
+    "acousticness": "REAL",
+    "instrumentalness": "REAL",
+    "liveness": "REAL",
+    "valence": "REAL",
+    "tempo": "REAL",
+    "type": "TEXT",
+    "uri": "TEXT",
+    "track_href": "TEXT",
+    "analysis_url": "TEXT",
+    "duration_ms": "INTEGER",
+    "time_signature": "INTEGER",
+}
+
+
+class FeatureStore(ABC):
+    """Audio features of tracks, keyed by track id"""
+
+    @abstractmethod
+    def __len__(self) -> int: ...
+
+    @abstractmethod
+    def upsert_many(self, features: Iterable[dict]) -> None:
+        """Insert `features`, replacing the ones already stored with the same id"""
+
+    @abstractmethod
+    def get_ids(self, ids: Iterable[str]) -> set[str]:
+        """Return the ids of `ids` that are stored"""
+
+    @abstractmethod
+    def to_dataframe(self, columns: list[str] | None = None) -> pd.DataFrame:
+        """Return the stored features (only `columns` if given) as a DataFrame"""
+
+    def close(self) -> None:  # noqa: B027
+        pass
+
+
+class SqliteFeatureStore(FeatureStore):
+    """
+    Feature store backed by an SQLite table with a primary key on `id`
+    path: SQLite file to store audio features
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        columns = ", ".join(f"{name} {sql_type}" for name, sql_type in AUDIO_FEATURE_COLUMNS.items())
+        self._connection.execute(f"CREATE TABLE IF NOT EXISTS audio_features ({columns})")
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM audio_features").fetchone()[0]
+
+    def upsert_many(self, features: Iterable[dict]) -> None:
+        columns = list(AUDIO_FEATURE_COLUMNS)
+        with self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO audio_features ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",  # noqa: S608
+                ([feature.get(column) for column in columns] for feature in features if feature),
+            )
+
+    def get_ids(self, ids: Iterable[str]) -> set[str]:
+        found = set()
+        for chunk in batched(set(ids), SQLITE_MAX_VARIABLES):
+            rows = self._connection.execute(
+                f"SELECT id FROM audio_features WHERE id IN ({','.join('?' * len(chunk))})",  # noqa: S608
+                chunk,
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def to_dataframe(self, columns: list[str] | None = None) -> pd.DataFrame:
+        selected = ", ".join(columns or AUDIO_FEATURE_COLUMNS)
+        return pd.read_sql_query(f"SELECT {selected} FROM audio_features", self._connection)  # noqa: S608
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def migrate_from_tinydb(tinydb_path: str | Path, store: FeatureStore) -> None:
+    """
+    Copy the audio features of a legacy TinyDB file into `store`, once
+    Duplicated ids of the TinyDB file are merged by the store primary key
+    The TinyDB file is then renamed with a `.migrated` suffix
+    """
+    tinydb_path = Path(tinydb_path)
+    if not tinydb_path.exists():
+        return
+    db = TinyDB(tinydb_path)
+    documents = db.all()
+    db.close()
+    store.upsert_many(documents)
+    logger.info("%i audio features migrated from %s (%i unique tracks)", len(documents), tinydb_path, len(store))
+    tinydb_path.rename(tinydb_path.with_suffix(tinydb_path.suffix + ".migrated"))
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import logging
+from itertools import chain, zip_longest
+from typing import TYPE_CHECKING
+
+from pydantic import BaseModel
+
+from sploty.spotify import SpotifyApiParams, get_many, spotify_batches
+from sploty.throttle import ordered_map
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from sploty.feature_store import FeatureStore
+    from sploty.track_cache import TrackCache
+
+logger = logging.getLogger(__name__)
+
+# key of the objects in the response of each batch endpoint
+RESPONSE_KEYS = {"tracks": "tracks", "audio-features": "audio_features"}
+
+
+class FetchPlan(BaseModel):
+    """
+    Unique track uris of a run and the ones each endpoint still has to be requested for,
+    tracks already cached, audio features already stored and ids known as missing are left out
+    """
+
+    track_uris: list[str]
+    tracks_to_get: list[str]
+    features_to_get: list[str]
+
+
+def plan_fetches(track_uris: Iterable[str], track_cache: TrackCache, db: FeatureStore | None = None) -> FetchPlan:
+    """
+    track_uris: track uris of the streams to enrich, with duplicates
+    db: feature store, None when the audio features are not needed
+    """
+    track_uris = list(dict.fromkeys(track_uris))
+    cached = track_cache.fresh_uris(track_uris) | track_cache.get_missing("tracks", track_uris)
+    stored = (db.get_ids(track_uris) | track_cache.get_missing("audio-features", track_uris)) if db is not None else set(track_uris)
+    plan = FetchPlan(
+        track_uris=track_uris,
+        tracks_to_get=[track_uri for track_uri in track_uris if track_uri not in cached],
+        features_to_get=[track_uri for track_uri in track_uris if track_uri not in stored],
+    )
+    # the tracks are requested here, the enrich stage then finds all of them in the cache
+    track_cache.count_lookups(len(plan.track_uris) - len(plan.tracks_to_get), len(plan.tracks_to_get))
+    logger.info(
+        "%i unique tracks, %i tracks and %i audio features to request",
+        len(plan.track_uris),
+        len(plan.tracks_to_get),
+        len(plan.features_to_get),
+    )
+    return plan
+
+
+def run_plan(
+    plan: FetchPlan,
+    tracks_params: SpotifyApiParams,
+    features_params: SpotifyApiParams | None,
+    track_cache: TrackCache,
+    db: FeatureStore | None = None,
+) -> None:
+    """
+    Request the tracks and the audio features of `plan` in a single pass of `tracks_params.concurrency` workers,
+    batches of both endpoints alternating, and store them in `track_cache` and `db`
+    Ids answered with null are stored as missing in `track_cache`
+    """
+    requests = [((tracks_params, batch) for batch in spotify_batches(tracks_params, plan.tracks_to_get))]
+    if features_params is not None and db is not None:
+        requests.append((features_params, batch) for batch in spotify_batches(features_params, plan.features_to_get))
+    interleaved = (request for request in chain.from_iterable(zip_longest(*requests)) if request is not None)
+
+    def fetch(request: tuple[SpotifyApiParams, tuple[str, ...]]) -> list:
+        params, batch = request
+        return get_many(params, batch, RESPONSE_KEYS[params.endpoint])
+
+    for (params, batch), objects in ordered_map(fetch, interleaved, tracks_params.concurrency):
+        found = {uri: found_object for uri, found_object in zip(batch, objects, strict=True) if found_object is not None}
+        if params.endpoint == "tracks":
+            track_cache.put_many(found)
+        else:
+            db.upsert_many(found.values())
+        track_cache.put_missing(params.endpoint, [uri for uri in batch if uri not in found])
@@ -1,40 +1,53 @@
 from __future__ import annotations
 
 import logging
+from typing import TYPE_CHECKING
 
-import pandas as pd
-from pandas.errors import EmptyDataError
+from sploty.id_index import IdIndex
+from sploty.journal import recover
+from sploty.schema import CONCATED_SCHEMA
+from sploty.storage import read_frame, write_frame
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 
 
-def main(concated_path: list, to_enrich_path: str, enriched_path: str | None = None):
+def filter_streams(df_stream: pd.DataFrame, id_index: IdIndex | None) -> pd.DataFrame:
     """
-    concated_path: file where read concated streaming history
-    to_enrich_path: file to write filtered streaming history
-    enriched_path: file where already enriched streaming history
+    df_stream: concated streaming history
+    id_index: ids of the already enriched streams
     """
-    # Read track history Spotify file
-    df_stream = pd.read_csv(concated_path)
     logger.info("%i rows to enrich", len(df_stream))
 
-    try:
-        df_already_enriched = pd.read_csv(enriched_path)
-        logger.info("%i enriched rows found", len(df_already_enriched))
-        # TODO there is an error : it lost new stream of a previously enriched track
-        # df_stream = df_stream[(~df_stream.track_uri.isin(df_already_enriched.track_uri)) | (df_stream.end_time > max(df_already_enriched.end_time))] # noqa: ERA001, E501
-        # df_stream = df_stream[(~df_stream.id.isin(df_already_enriched.id))]  noqa: ERA001
-        df_stream = df_stream[df_stream.end_time > max(df_already_enriched.end_time)]
+    if id_index is not None:
+        logger.info("%i enriched rows found", len(id_index))
+        df_stream = df_stream[~id_index.contains(df_stream["id"])]
         logger.info("only %i rows to enrich", len(df_stream))
-    except EmptyDataError:
-        logger.warning("empty backup file found (%s)", enriched_path)
-    except FileNotFoundError:
-        logger.warning("no backup file found (%s)", enriched_path)
+    else:
+        logger.warning("no already enriched streams found")
 
     # Drop NaN row
-    df_stream = df_stream[df_stream["track_uri"].notna()]
+    df_stream = df_stream[df_stream["track_uri"].notna()].reset_index(drop=True)
     logger.info("%i rows to enrich without empty track_uri", len(df_stream))
+    return df_stream
+
+
+def main(concated_path: list, to_enrich_path: str, enriched_path: str | None = None):
+    """
+    concated_path: file where read concated streaming history
+    to_enrich_path: file to write filtered streaming history
+    enriched_path: file where already enriched streaming history
+    """
+    # Read track history Spotify file
+    df_stream = read_frame(concated_path, schema=CONCATED_SCHEMA)
+    if enriched_path:
+        recover(enriched_path)
+    id_index = IdIndex.of_history(enriched_path) if enriched_path else None
+
+    df_stream = filter_streams(df_stream, id_index)
 
     # Save stream to enrich
-    df_stream.to_csv(to_enrich_path, mode="w", index=False)
+    write_frame(df_stream, to_enrich_path, CONCATED_SCHEMA)
     logger.info("%i rows are saved at %s", len(df_stream), to_enrich_path)
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+
+from sploty.id_index import hash_ids
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+logger = logging.getLogger(__name__)
+
+
+def first_seen_path(history_path: str | Path) -> Path:
+    history_path = Path(history_path)
+    return history_path.with_name(f"{history_path.stem}_first_seen.npz")
+
+
+def stream_times(end_time: pd.Series) -> np.ndarray:
+    """Nanoseconds since the epoch of ISO `end_time` values"""
+    return pd.DatetimeIndex(pd.to_datetime(end_time, utc=True)).asi8
+
+
+class FirstSeen:
+    """
+    First stream of each value of some columns (track, artist and album uris): the hashed values, sorted,
+    with the time and the hashed id of their first stream
+    A part of the history is flagged alone against the first listens of all the streams seen before it
+    """
+
+    def __init__(self, columns: Iterable[str], arrays: dict[str, np.ndarray] | None = None) -> None:
+        self.columns = list(columns)
+        empty = {"keys": np.array([], dtype=np.uint64), "times": np.array([], dtype=np.int64), "ids": np.array([], dtype=np.uint64)}
+        self.arrays = arrays or {f"{column}.{name}": array for column in self.columns for name, array in empty.items()}
+
+    def __len__(self) -> int:
+        return len(self.arrays[f"{self.columns[0]}.keys"])
+
+    @classmethod
+    def load(cls, path: str | Path, columns: Iterable[str]) -> FirstSeen:
+        """First listens saved at `path`, empty if there are none"""
+        path = Path(path)
+        if not path.exists():
+            return cls(columns)
+        with np.load(path) as arrays:
+            first_seen = cls(columns, dict(arrays))
+        logger.info("%i first listens found in %s", len(first_seen), path)
+        return first_seen
+
+    def update(self, df_stream: pd.DataFrame) -> list[str]:
+        """
+        Add the streams of `df_stream` (`end_time`, `id` and the columns), the earliest stream of a value stays its first listen
+        On equal times, the streams already seen and then the first rows win
+        Return the months (year-month) of the first listens replaced by earlier streams, their flags changed
+        """
+        times = stream_times(df_stream["end_time"])
+        ids = hash_ids(df_stream["id"])
+        replaced_times = []
+        for column in self.columns:
+            keys, first_times, first_ids = (self.arrays[f"{column}.{name}"] for name in ("keys", "times", "ids"))
+            all_keys = np.concatenate([keys, hash_ids(df_stream[column])])
+            all_times = np.concatenate([first_times, times])
+            all_ids = np.concatenate([first_ids, ids])
+            # sorted by value, then time, then position, the first row of each value is its first stream
+            order = np.lexsort((np.arange(len(all_keys)), all_times, all_keys))
+            first = order[np.concatenate([[True], all_keys[order][1:] != all_keys[order][:-1]])]
+            self.arrays[f"{column}.keys"], self.arrays[f"{column}.times"], self.arrays[f"{column}.ids"] = all_keys[first], all_times[first], all_ids[first]
+            replaced = self.arrays[f"{column}.ids"][np.searchsorted(self.arrays[f"{column}.keys"], keys)] != first_ids
+            replaced_times.append(first_times[replaced])
+        replaced_times = np.unique(np.concatenate(replaced_times))
+        return sorted(set(pd.to_datetime(replaced_times, utc=True).strftime("%Y-%m")))
+
+    def is_first(self, df_stream: pd.DataFrame, column: str) -> np.ndarray:
+        """Mask of the streams of `df_stream` that are the first listen of their `column` value, once updated with them"""
+        keys = self.arrays[f"{column}.keys"]
+        positions = np.searchsorted(keys, hash_ids(df_stream[column])).clip(max=max(len(keys) - 1, 0))
+        return self.arrays[f"{column}.ids"][positions] == hash_ids(df_stream["id"]) if len(keys) else np.zeros(len(df_stream), dtype=bool)
+
+    def save(self, path: str | Path) -> None:
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with tmp_path.open("wb") as file:
+            np.savez(file, **self.arrays)
+        tmp_path.replace(path)
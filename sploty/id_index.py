@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pandas.errors import EmptyDataError
+
+from sploty.storage import read_frame
+
+logger = logging.getLogger(__name__)
+
+# fixed 16 bytes key so that hashes are the same from one run to another
+HASH_KEY = "sploty-stream-id"
+
+
+def hash_ids(ids: pd.Series) -> np.ndarray:
+    """64-bit hashes of stream ids (`end_time:track_uri`)"""
+    return pd.util.hash_pandas_object(ids.astype(object), index=False, hash_key=HASH_KEY).to_numpy()
+
+
+def encode_ids(ids: pd.Series) -> np.ndarray:
+    """Stream ids as fixed width bytes, which numpy sorts and searches"""
+    return ids.astype(str).str.encode("utf-8").to_numpy().astype(bytes)
+
+
+def id_index_path(history_path: str | Path) -> Path:
+    history_path = Path(history_path)
+    return history_path.with_name(f"{history_path.stem}_ids.npy")
+
+
+class IdIndex:
+    """
+    Sorted array of the ids of already processed streams
+    Membership is a binary search, so checking new streams does not depend on the history length
+    The ids themselves are kept rather than hashes, a hash collision would leave a new stream out
+    """
+
+    def __init__(self, ids: np.ndarray) -> None:
+        self.ids = ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_ids(cls, ids: pd.Series) -> IdIndex:
+        return cls(np.unique(encode_ids(ids)))
+
+    @classmethod
+    def load(cls, path: str | Path) -> IdIndex | None:
+        """Index saved in `path`, None if it holds the hashes of an older version"""
+        ids = np.load(path, mmap_mode="r")
+        if ids.dtype.kind != "S":
+            logger.warning("id index with hashes found (%s), it is rebuilt", path)
+            return None
+        return cls(ids)
+
+    @classmethod
+    def of_history(cls, history_path: str | Path) -> IdIndex | None:
+        """
+        Index of the ids of a history file, None if there is no history
+        It is rebuilt from the `id` column of the file when it is missing or older than the file
+        """
+        history_path = Path(history_path)
+        path = id_index_path(history_path)
+        if not history_path.exists():
+            return None
+        if path.exists() and path.stat().st_mtime >= history_path.stat().st_mtime:
+            id_index = cls.load(path)
+            if id_index is not None:
+                logger.info("%i ids found in %s", len(id_index), path)
+                return id_index
+        try:
+            ids = read_frame(history_path, columns=["id"])["id"]
+        except EmptyDataError:
+            logger.warning("empty history file found (%s)", history_path)
+            return None
+        id_index = cls.from_ids(ids.dropna())
+        id_index.save(path)
+        logger.info("%i ids indexed from %s", len(id_index), history_path)
+        return id_index
+
+    def contains(self, ids: pd.Series) -> np.ndarray:
+        return self._contains(encode_ids(ids))
+
+    def _contains(self, encoded: np.ndarray) -> np.ndarray:
+        if len(self.ids) == 0:
+            return np.zeros(len(encoded), dtype=bool)
+        positions = np.searchsorted(self.ids, encoded).clip(max=len(self.ids) - 1)
+        return self.ids[positions] == encoded
+
+    def add(self, ids: pd.Series) -> None:
+        """Insert the new ids at their place, the index is not sorted again"""
+        new_ids = np.unique(encode_ids(ids.dropna()))
+        new_ids = new_ids[~self._contains(new_ids)]
+        # a longer id widens the array rather than being truncated
+        width = max(self.ids.dtype.itemsize, new_ids.dtype.itemsize)
+        self.ids = np.insert(self.ids.astype(f"S{width}", copy=False), np.searchsorted(self.ids, new_ids), new_ids)
+
+    def save(self, path: str | Path) -> None:
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with tmp_path.open("wb") as file:
+            np.save(file, self.ids)
+        tmp_path.replace(path)
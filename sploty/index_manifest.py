@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import logging
+from itertools import batched
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from elasticsearch import NotFoundError, helpers
+
+from sploty.id_index import hash_ids
+
+logger = logging.getLogger(__name__)
+
+# ids read at once from the index by `reconcile`
+SCAN_BATCH_SIZE = 10_000
+
+
+def hash_documents(df: pd.DataFrame) -> np.ndarray:
+    """64-bit hash of the content of each row"""
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+class IndexManifest:
+    """
+    Hashed ids of the documents sent to an index with a hash of their content
+    Both arrays are sorted by id, so finding the new or changed documents of a chunk is a binary search
+    """
+
+    def __init__(self, ids: np.ndarray, contents: np.ndarray) -> None:
+        self.ids = ids
+        self.contents = contents
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, path: str | Path) -> IndexManifest:
+        """Manifest saved at `path`, empty if there is none"""
+        path = Path(path)
+        if not path.exists():
+            return cls(np.array([], dtype=np.uint64), np.array([], dtype=np.uint64))
+        with np.load(path) as arrays:
+            manifest = cls(arrays["ids"], arrays["contents"])
+        logger.info("%i indexed documents found in %s", len(manifest), path)
+        return manifest
+
+    def changed(self, ids: np.ndarray, contents: np.ndarray) -> np.ndarray:
+        """Mask of the documents that are not indexed yet or whose content changed"""
+        if len(self.ids) == 0:
+            return np.ones(len(ids), dtype=bool)
+        positions = np.searchsorted(self.ids, ids).clip(max=len(self.ids) - 1)
+        return (self.ids[positions] != ids) | (self.contents[positions] != contents)
+
+    def update(self, ids: np.ndarray, contents: np.ndarray) -> None:
+        """Add or replace documents, the last given content of an id wins"""
+        all_ids = np.concatenate([ids[::-1], self.ids])
+        all_contents = np.concatenate([contents[::-1], self.contents])
+        self.ids, first = np.unique(all_ids, return_index=True)
+        self.contents = all_contents[first]
+
+    def keep(self, ids: np.ndarray) -> None:
+        """Forget the documents whose id is not in `ids`"""
+        kept = np.isin(self.ids, ids)
+        self.ids, self.contents = self.ids[kept], self.contents[kept]
+
+    def save(self, path: str | Path) -> None:
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with tmp_path.open("wb") as file:
+            np.savez(file, ids=self.ids, contents=self.contents)
+        tmp_path.replace(path)
+
+
+def reconcile(manifest: IndexManifest, elastic, index_name: str) -> None:
+    """
+    Scan the ids of the index and forget the documents of the manifest that are missing from it
+    They are sent again by the next sync (e.g. after the index has been deleted)
+    """
+    try:
+        hits = helpers.scan(elastic, index=index_name, query={"query": {"match_all": {}}}, _source=False, size=SCAN_BATCH_SIZE)
+        id_hashes = [hash_ids(pd.Series([hit["_id"] for hit in batch])) for batch in batched(hits, SCAN_BATCH_SIZE)]
+    except NotFoundError:
+        logger.warning("index %s not found", index_name)
+        id_hashes = []
+    number_of_documents = len(manifest)
+    manifest.keep(np.concatenate([np.array([], dtype=np.uint64), *id_hashes]))
+    logger.info("%i documents of the manifest are missing from %s", number_of_documents - len(manifest), index_name)
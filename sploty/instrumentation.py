@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import cProfile
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from pydantic import BaseModel
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def peak_rss_mib() -> float:
+    """Peak resident set size of the process, in MiB"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+
+
+class Histogram:
+    """Number of observations per bucket, the last bucket counts the observations above every bound"""
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> dict:
+        bounds = [*map(str, self.bounds), "inf"]
+        return {"count": self.count, "sum": self.sum, "max": self.max, "buckets": dict(zip(bounds, self.buckets, strict=True))}
+
+
+class StageReport(BaseModel):
+    """
+    wall_seconds, cpu_seconds: time spent in the stage, cpu time of every thread
+    peak_rss_mib: peak resident set size of the process at the end of the stage
+    rows_in, rows_out: rows read and produced by the stage
+    """
+
+    name: str
+    wall_seconds: float = 0
+    cpu_seconds: float = 0
+    peak_rss_mib: float = 0
+    rows_in: int | None = None
+    rows_out: int | None = None
+
+    def rows(self, rows_in: int, rows_out: int):
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+
+
+class RunReport:
+    """
+    Measures of a run: stages, counters (API calls, retries, bytes...) and latency histograms
+    It is written as JSON after each stage, so a failed run still leaves a report
+    """
+
+    def __init__(self, path: Path | None = None, profile_path: Path | None = None) -> None:
+        self._lock = threading.Lock()
+        self.start(path, profile_path)
+
+    def start(self, path: Path | None = None, profile_path: Path | None = None):
+        """
+        Forget the previous measures
+        path: file where write the report
+        profile_path: folder where dump the cProfile stats of each stage
+        """
+        with self._lock:
+            self.started_at = datetime.now(UTC)
+            self.stages: list[StageReport] = []
+            self.counters = Counter()
+            self.histograms: dict[str, Histogram] = {}
+            self.path = path
+            self.profile_path = profile_path
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self.histograms.setdefault(name, Histogram()).observe(value)
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        """Observe the latency of the block in the `name` histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageReport]:
+        """Measure a stage of the pipeline, profiled with cProfile if there is a `profile_path`"""
+        stage_report = StageReport(name=name)
+        profiler = cProfile.Profile() if self.profile_path is not None else None
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage_report
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profile_path.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(self.profile_path / f"{name}.prof")
+            stage_report.wall_seconds = time.perf_counter() - wall_start
+            stage_report.cpu_seconds = time.process_time() - cpu_start
+            stage_report.peak_rss_mib = peak_rss_mib()
+            self.stages.append(stage_report)
+            logger.info(
+                "%s took %.1fs (%.1fs of cpu), peak RSS is %i MiB",
+                name,
+                stage_report.wall_seconds,
+                stage_report.cpu_seconds,
+                stage_report.peak_rss_mib,
+            )
+            self.write()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "started_at": self.started_at.isoformat(),
+                "stages": [stage_report.model_dump() for stage_report in self.stages],
+                "counters": dict(self.counters),
+                "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            }
+
+    def write(self):
+        if self.path is not None:
+            self.path.write_text(json.dumps(self.to_dict(), indent=2), encoding="UTF-8")
+
+
+# report of the current run, filled by every module
+run_report = RunReport()
+
+
+def start_run(path: str | Path | None = None, profile_path: str | Path | None = None):
+    """
+    path: file where write the run report
+    profile_path: folder where dump the cProfile stats of each stage
+    """
+    run_report.start(Path(path) if path is not None else None, Path(profile_path) if profile_path is not None else None)
+
+
+def count(name: str, value: int = 1):
+    run_report.count(name, value)
+
+
+def timed(name: str):
+    return run_report.timed(name)
+
+
+def stage(name: str):
+    return run_report.stage(name)
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pandas as pd
+
+from sploty.id_index import IdIndex, id_index_path
+from sploty.storage import append_mark, rollback_frame
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+logger = logging.getLogger(__name__)
+
+
+def journal_path(history_path: str | Path) -> Path:
+    history_path = Path(history_path)
+    return history_path.with_name(f"{history_path.stem}_journal.jsonl")
+
+
+class EnrichJournal:
+    """
+    Write-ahead journal of the batches appended to the enriched history by `enrich.better_enrich`
+    The first line is the mark of the history when the journal starts, then each batch is committed by a line
+    with its track uris, the API responses, the ids of its streams (left out ones included) and the mark of the history after the append
+    Rows of the history after the last committed mark belong to a batch that was never committed
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.start_mark = None
+        self.batches = []
+        if self.path.exists():
+            self._read()
+
+    def _read(self) -> None:
+        with self.path.open(encoding="UTF-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line was being written when the run stopped
+                    break
+                if "start_mark" in entry:
+                    self.start_mark = entry["start_mark"]
+                else:
+                    self.batches.append(entry)
+        logger.info("%i committed batches found in %s", len(self.batches), self.path)
+
+    @property
+    def last_mark(self) -> int | None:
+        return self.batches[-1]["mark"] if self.batches else self.start_mark
+
+    def tracks(self) -> dict:
+        """Tracks found by the API in the committed batches, by track uri"""
+        return {track_uri: track for batch in self.batches for track_uri, track in zip(batch["track_uris"], batch["tracks"], strict=True) if track is not None}
+
+    def ids(self) -> pd.Series:
+        """Ids of the streams of the committed batches"""
+        return pd.Series([stream_id for batch in self.batches for stream_id in batch["ids"]], dtype=object)
+
+    def _write(self, entry: dict) -> None:
+        with self.path.open("a", encoding="UTF-8") as file:
+            file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def start(self, history_path: str | Path):
+        """Record the mark of the history before the first batch of a run, unless a previous run is being resumed"""
+        if self.start_mark is None:
+            self.start_mark = append_mark(history_path)
+            self._write({"start_mark": self.start_mark})
+
+    def commit(self, track_uris: Iterable[str], tracks: list, ids: Iterable[str], mark: int):
+        """Record a batch whose streams are appended to the history, up to `mark`"""
+        entry = {"mark": mark, "track_uris": list(track_uris), "tracks": tracks, "ids": list(ids)}
+        self._write(entry)
+        self.batches.append(entry)
+
+    def close(self):
+        """Remove the journal once every batch is written and indexed"""
+        self.path.unlink(missing_ok=True)
+
+
+def recover(history_path: str | Path) -> None:
+    """
+    Bring the enriched history back to its last committed batch after an interrupted run
+    Uncommitted rows are removed and the ids of the committed batches are added to the id index,
+    which was up to date when the journal started, so the history is not read again
+    """
+    journal = EnrichJournal(journal_path(history_path))
+    if journal.last_mark is None:
+        return
+    rollback_frame(history_path, journal.last_mark)
+    index_path = id_index_path(history_path)
+    id_index = IdIndex.load(index_path) if index_path.exists() else None
+    if id_index is not None:
+        id_index.add(journal.ids())
+        id_index.save(index_path)
+        logger.info("%i ids of committed batches added to %s", len(journal.ids()), index_path)
@@ -1,31 +1,42 @@
 import logging
+from functools import cache
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from pandas import DatetimeIndex
+
+from sploty.first_seen import FirstSeen
+from sploty.schema import FEATURED_SCHEMA, METRICS_SCHEMA, apply_schema
+from sploty.storage import read_frame, write_frame
 
 logger = logging.getLogger(__name__)
 
 
+NORMALIZED_PLATFORMS = {
+    "android": "Android OS",
+    "partner android_tv": "Android TV",
+    "partner google cast": "Chromecast",
+    "ios": "iOS",
+    "partner ios": "iOS",
+    "osx": "MacOS",
+    "os x": "MacOS",
+    "sonos_": "Sonos",
+    "partner sonos": "Sonos",
+    "partner webos_tv": "WebOS tv",
+    "webplayer": "WebPlayer",
+    "web_player": "WebPlayer",
+    "partner spotify web_player": "WebPlayer",
+    "windows": "Windows",
+    "not_applicable": "not_applicable",
+}
+
+# flag of the first listen of each track, artist and album, and its column
+FIRST_LISTEN_COLUMNS = {"is_new_track": "track_uri", "is_new_artist": "artist_uri", "is_new_album": "album_uri"}
+
+
+@cache
 def normalize_platform(platform: str):
-    normalized = {
-        "android": "Android OS",
-        "partner android_tv": "Android TV",
-        "partner google cast": "Chromecast",
-        "ios": "iOS",
-        "partner ios": "iOS",
-        "osx": "MacOS",
-        "os x": "MacOS",
-        "sonos_": "Sonos",
-        "partner sonos": "Sonos",
-        "partner webos_tv": "WebOS tv",
-        "webplayer": "WebPlayer",
-        "web_player": "WebPlayer",
-        "partner spotify web_player": "WebPlayer",
-        "windows": "Windows",
-        "not_applicable": "not_applicable",
-    }
-    normalized_matches = [value for key, value in normalized.items() if platform.lower().startswith(key.lower())]
+    normalized_matches = [value for key, value in NORMALIZED_PLATFORMS.items() if platform.lower().startswith(key.lower())]
     if len(normalized_matches) > 1:
         logger.warning(
             "There are several matches for the `%s` platform: %s (the first one is taken)",
@@ -39,30 +50,69 @@ def normalize_platform(platform: str):
     return normalized_matches[0]
 
 
-def main(enriched_path: Path, metrics_path: Path):
-    df_stream = pd.read_csv(enriched_path)
-
-    df_stream["year"] = DatetimeIndex(df_stream.end_time).year.map(lambda x: f"{x:0>4}")
-    df_stream["month"] = (DatetimeIndex(df_stream.end_time).month).map(lambda x: f"{x:0>2}")
-    df_stream["month_name"] = DatetimeIndex(df_stream.end_time).month_name()
-    df_stream["day"] = DatetimeIndex(df_stream.end_time).day.map(lambda x: f"{x:0>2}")
-    df_stream["day_of_week"] = DatetimeIndex(df_stream.end_time).day_of_week.map(lambda x: f"{x:0>2}")
-    df_stream["day_name"] = DatetimeIndex(df_stream.end_time).day_name()
-    df_stream["hour"] = DatetimeIndex(df_stream.end_time).hour.map(lambda x: f"{x:0>2}")
-    df_stream["minute"] = DatetimeIndex(df_stream.end_time).minute.map(lambda x: f"{x:0>2}")
+def map_unique(values: pd.Series, func) -> pd.Series:
+    """Apply `func` once per distinct value of `values`, missing values stay missing"""
+    codes, uniques = pd.factorize(values)
+    mapped = np.array([func(value) for value in uniques] + [None], dtype=object)
+    # code -1 (missing value) takes the trailing None
+    return pd.Series(mapped[codes], index=values.index)
+
+
+def zero_padded(values: pd.Series, width: int) -> pd.Series:
     # ":04" writting is fixed in Python 3.10+ : https://stackoverflow.com/a/36044788
+    return map_unique(values, lambda value: f"{value:0>{width}}")
+
+
+def first_listens(df_stream: pd.DataFrame, times: pd.Series) -> dict[str, np.ndarray]:
+    """Flags of the first stream of each track, artist and album of a whole history, in `end_time` order"""
+    if times.is_monotonic_increasing:
+        return {flag: ~df_stream[column].duplicated(keep="first").to_numpy() for flag, column in FIRST_LISTEN_COLUMNS.items()}
+    # late streams appended after later ones are ordered back, on equal times the first rows win
+    order = np.argsort(times.to_numpy(), kind="stable")
+    flags = {}
+    for flag, column in FIRST_LISTEN_COLUMNS.items():
+        flags[flag] = np.empty(len(df_stream), dtype=bool)
+        flags[flag][order] = ~df_stream[column].take(order).duplicated(keep="first").to_numpy()
+    return flags
+
+
+def compute_metrics(df_stream: pd.DataFrame, first_seen: FirstSeen | None = None) -> pd.DataFrame:
+    """
+    df_stream: featured streaming history
+    first_seen: first listens of the whole history, already updated with the streams of `df_stream` (see `Pipeline.streams_to_metric`),
+    when `df_stream` is only a part of the history
+    """
+    times = pd.to_datetime(df_stream.end_time)
+    end_time = times.dt
+    df_stream["year"] = zero_padded(end_time.year, 4)
+    df_stream["month"] = zero_padded(end_time.month, 2)
+    df_stream["month_name"] = end_time.month_name()
+    df_stream["day"] = zero_padded(end_time.day, 2)
+    df_stream["day_of_week"] = zero_padded(end_time.day_of_week, 2)
+    df_stream["day_name"] = end_time.day_name()
+    df_stream["hour"] = zero_padded(end_time.hour, 2)
+    df_stream["minute"] = zero_padded(end_time.minute, 2)
 
     df_stream["min_played"] = df_stream.ms_played / 1000 / 60
 
     df_stream["percentage_played"] = round((df_stream.ms_played / df_stream.track_duration_ms) * 100, 2)
     df_stream["percentage_played"] = df_stream["percentage_played"].clip(0, 100)
 
-    df_stream["is_new_track"] = ~df_stream["track_uri"].duplicated(keep="first")
-    df_stream["is_new_artist"] = ~df_stream["artist_uri"].duplicated(keep="first")
-    df_stream["is_new_album"] = ~df_stream["album_uri"].duplicated(keep="first")
+    if first_seen is not None:
+        flags = {flag: first_seen.is_first(df_stream, column) for flag, column in FIRST_LISTEN_COLUMNS.items()}
+    else:
+        flags = first_listens(df_stream, times)
+    for flag, is_first in flags.items():
+        df_stream[flag] = is_first
 
-    df_stream["normalized_platform"] = df_stream["platform"].apply(normalize_platform)
+    df_stream["normalized_platform"] = map_unique(df_stream["platform"], normalize_platform)
 
-    df_stream["skipped"] = df_stream["skipped"].astype(bool)
+    df_stream["skipped"] = df_stream["skipped"].fillna(value=False).astype(bool)
 
-    df_stream.to_csv(metrics_path, mode="w", index=False)
+    return apply_schema(df_stream, METRICS_SCHEMA)
+
+
+def main(enriched_path: Path, metrics_path: Path):
+    df_stream = read_frame(enriched_path, schema=FEATURED_SCHEMA)
+    df_stream = compute_metrics(df_stream)
+    write_frame(df_stream, metrics_path, METRICS_SCHEMA)
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING
+
+import pandas as pd
+
+from sploty.first_seen import FirstSeen, first_seen_path
+from sploty.metrics import FIRST_LISTEN_COLUMNS
+from sploty.schema import CONCATED_SCHEMA, ENRICHED_SCHEMA, FEATURED_SCHEMA, METRICS_SCHEMA, apply_schema
+from sploty.storage import month_of, partition_months, read_frame, read_partitions, write_frame, write_partitions
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from pathlib import Path
+
+    from sploty.artifacts import Stage, StorageFormat
+
+logger = logging.getLogger(__name__)
+
+# artifact written by each stage and its schema
+ARTIFACTS: dict[Stage, tuple[str, dict[str, str]]] = {
+    "concat": ("concated", CONCATED_SCHEMA),
+    "filter": ("filtered", CONCATED_SCHEMA),
+    "enrich": ("enriched", ENRICHED_SCHEMA),
+    "feature": ("featured", FEATURED_SCHEMA),
+    "metric": ("metrics", METRICS_SCHEMA),
+}
+# stages whose artifact can be partitioned by month
+PARTITIONED_STAGES: set[Stage] = {"feature", "metric"}
+
+
+def in_range(months: Iterable[str], since: str | None = None, until: str | None = None) -> list[str]:
+    """`months` (year-month) between `since` and `until` included, in order"""
+    return sorted(month for month in months if (since is None or month >= since) and (until is None or month <= until))
+
+
+def months_to_process(months: Iterable[str], new_months: Iterable[str], processed_months: Iterable[str], since: str | None, until: str | None) -> list[str]:
+    """
+    Months of `months` a stage processes: the ones between `since` and `until` if one is given,
+    else the months of the new streams and the ones never processed
+    """
+    months = set(months)
+    if since is not None or until is not None:
+        return in_range(months, since, until)
+    return sorted(months & (set(new_months) | (months - set(processed_months))))
+
+
+class Pipeline:
+    """
+    Pass the stage DataFrames in memory, each artifact is read at most once
+    paths: file of each artifact, folder of its partitions for the partitioned ones
+    checkpoint_stages: stages whose artifact is written
+    partitioned_format: format of the monthly partitions of the artifacts of `PARTITIONED_STAGES`, None to write them as single files
+    since, until: first and last months (year-month) to process when the artifacts are partitioned
+    """
+
+    def __init__(
+        self,
+        paths: dict[str, Path],
+        checkpoint_stages: set[Stage],
+        partitioned_format: StorageFormat | None = None,
+        since: str | None = None,
+        until: str | None = None,
+    ) -> None:
+        self.paths = paths
+        self.checkpoint_stages = checkpoint_stages
+        self.partitioned_format = partitioned_format
+        self.since = since
+        self.until = until
+        self.frames: dict[str, pd.DataFrame] = {}
+        # months of the partitioned artifacts held in memory, the ones processed by this run
+        self.months: dict[str, list[str]] = {}
+        self.new_enriched: pd.DataFrame | None = None
+        self.first_seen: FirstSeen | None = None
+
+    def is_partitioned(self, stage: Stage) -> bool:
+        return self.partitioned_format is not None and stage in PARTITIONED_STAGES
+
+    def partition_months(self, stage: Stage) -> list[str]:
+        """Months of the partitions of the artifact of `stage`, written or held in memory"""
+        artifact, _ = ARTIFACTS[stage]
+        return sorted(set(partition_months(self.paths[artifact])) | set(self.months.get(artifact, [])))
+
+    def load(self, stage: Stage) -> pd.DataFrame:
+        """Return the artifact of `stage`, read from its file if the stage did not run"""
+        if stage == "enrich":
+            return self.load_enriched()
+        if self.is_partitioned(stage):
+            return self.load_months(stage, self.partition_months(stage))
+        artifact, schema = ARTIFACTS[stage]
+        if artifact not in self.frames:
+            logger.info("read %s artifact from %s", artifact, self.paths[artifact])
+            self.frames[artifact] = read_frame(self.paths[artifact], schema=schema)
+        return self.frames[artifact]
+
+    def load_enriched(self) -> pd.DataFrame:
+        """Return the enriched streaming history, of the previous runs and of this one"""
+        artifact, schema = ARTIFACTS["enrich"]
+        if artifact not in self.frames:
+            path = self.paths[artifact]
+            frames = [read_frame(path, schema=schema)] if path.exists() else []
+            if self.new_enriched is not None:
+                frames.append(self.new_enriched)
+            self.frames[artifact] = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=list(schema))
+        return self.frames[artifact]
+
+    def load_months(self, stage: Stage, months: Iterable[str]) -> pd.DataFrame:
+        """Return the partitions of `months` of the artifact of `stage`, from memory for the ones this run processed"""
+        artifact, schema = ARTIFACTS[stage]
+        months = list(months)
+        in_memory = self.months.get(artifact, [])
+        frames = [read_partitions(self.paths[artifact], [month for month in months if month not in in_memory], schema=schema)]
+        if in_memory:
+            df_memory = self.frames[artifact]
+            frames.append(df_memory[month_of(df_memory["end_time"]).isin(months)])
+        frames = [frame for frame in frames if len(frame)] or frames[:1]
+        if len(frames) == 1:
+            return frames[0]
+        # partitions read from the disk and the ones held in memory are put back in month order
+        df = pd.concat(frames, ignore_index=True)
+        return apply_schema(df.iloc[month_of(df["end_time"]).argsort(kind="stable")].reset_index(drop=True), schema)
+
+    def save(self, stage: Stage, df: pd.DataFrame) -> None:
+        """
+        Keep the artifact of `stage` in memory, and write it if it is a checkpoint
+        A partitioned artifact only gets the partitions of the months of `df`, the other ones are left untouched
+        """
+        artifact, schema = ARTIFACTS[stage]
+        self.frames[artifact] = df
+        if self.is_partitioned(stage):
+            self.months[artifact] = sorted(month_of(df["end_time"]).unique())
+        if stage not in self.checkpoint_stages:
+            return
+        if self.is_partitioned(stage):
+            if stage == "metric" and self.first_seen is not None:
+                # saved first, the partitions of an interrupted run are processed again and their streams are already seen
+                self.first_seen.save(first_seen_path(self.paths[artifact]))
+            write_partitions(df, self.paths[artifact], self.partitioned_format, schema)
+            logger.info("%i rows are saved in %i partitions of %s", len(df), len(self.months[artifact]), self.paths[artifact])
+        else:
+            write_frame(df, self.paths[artifact], schema)
+            logger.info("%i rows are saved at %s", len(df), self.paths[artifact])
+
+    def streams_to_feature(self, df_filtered: pd.DataFrame) -> pd.DataFrame:
+        """
+        Enriched streams the feature stage processes, all of them unless the featured artifact is partitioned,
+        else the ones of the months of the new streams `df_filtered` and of the months never featured (see `months_to_process`)
+        """
+        df_enriched = self.load("enrich")
+        if not self.is_partitioned("feature"):
+            return df_enriched
+        enriched_months = month_of(df_enriched["end_time"])
+        new_months = month_of(df_filtered["end_time"]).unique()
+        months = months_to_process(enriched_months.unique(), new_months, self.partition_months("feature"), self.since, self.until)
+        logger.info("%i months to feature", len(months))
+        return df_enriched[enriched_months.isin(months)].reset_index(drop=True)
+
+    def streams_to_metric(self) -> tuple[pd.DataFrame, FirstSeen | None]:
+        """
+        Featured streams the metrics stage processes, with the first listens of the history updated with them (see `metrics.compute_metrics`)
+        All of them unless the metrics artifact is partitioned, else the months featured by this run, or never processed,
+        and the months whose first listens are replaced by earlier streams of these ones
+        """
+        if not self.is_partitioned("metric"):
+            return self.load("feature"), None
+        featured_months = self.partition_months("feature")
+        months = self.months.get("featured")
+        if months is None:
+            months = months_to_process(featured_months, [], self.partition_months("metric"), self.since, self.until)
+        path = first_seen_path(self.paths["metrics"])
+        # the first listens are computed again from all the streams when all of them are processed
+        self.first_seen = FirstSeen(FIRST_LISTEN_COLUMNS.values())
+        if set(months) != set(featured_months) and path.exists():
+            self.first_seen = FirstSeen.load(path, FIRST_LISTEN_COLUMNS.values())
+        elif set(months) != set(featured_months):
+            logger.warning("no first listens found at %s, all months are processed", path)
+            months = featured_months
+        df_featured = self.load_months("feature", months)
+        # the only update of the first listens, the streams of the replaced months were already added by the runs which processed them
+        replaced_months = [month for month in self.first_seen.update(df_featured) if month not in months]
+        logger.info("%i months to compute, %i months whose first listens are replaced", len(months), len(replaced_months))
+        if replaced_months:
+            df_featured = self.load_months("feature", [*months, *replaced_months])
+        return df_featured, self.first_seen
+
+    def streams_to_index(self, *, rebuild: bool = False) -> pd.DataFrame:
+        """
+        Streams the elastic stage indexes, all of them unless the metrics artifact is partitioned,
+        else the months computed by this run or, if the metrics stage did not run, the ones between `since` and `until`
+        rebuild: the index is rebuilt, all months are indexed
+        """
+        if not self.is_partitioned("metric") or rebuild:
+            return self.load("metric")
+        months = self.months.get("metrics", in_range(self.partition_months("metric"), self.since, self.until))
+        logger.info("%i months to index", len(months))
+        return self.load_months("metric", months)
+
+    def extend_enriched(self, df_enriched: pd.DataFrame, *, appended: bool) -> None:
+        """
+        Add newly enriched streams to the enriched streaming history
+        appended: the enrich stage already appended them to its file
+        """
+        self.frames.pop(ARTIFACTS["enrich"][0], None)
+        if not appended:
+            self.new_enriched = df_enriched
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# text columns repeated across streams are categoricals, each distinct value is stored once
+# columns of the concatenated streaming history (see `concat.main`)
+CONCATED_SCHEMA = {
+    "end_time": "string",
+    "username": "category",
+    "platform": "category",
+    "ms_played": "Int64",
+    "conn_country": "category",
+    "ip_addr": "string",
+    "ip_addr_decrypted": "string",
+    "user_agent_decrypted": "string",
+    "track_name": "category",
+    "artist_name": "category",
+    "album_name": "category",
+    "reason_start": "category",
+    "reason_end": "category",
+    "shuffle": "boolean",
+    "skipped": "boolean",
+    "offline": "boolean",
+    "offline_timestamp": "Int64",
+    "incognito_mode": "boolean",
+    "audiobook_title": "string",
+    "audiobook_uri": "string",
+    "audiobook_chapter_uri": "string",
+    "audiobook_chapter_title": "string",
+    "track_uri": "category",
+    "id": "string",
+}
+
+# columns added by `enrich.better_enrich`
+ENRICHED_SCHEMA = CONCATED_SCHEMA | {
+    "artist_uri": "category",
+    "track_duration_ms": "Int64",
+    "track_popularity": "Int64",
+    "track_is_explicit": "boolean",
+    "track_is_local": "boolean",
+    "track_is_playable": "boolean",
+    "album_uri": "category",
+    "album_type": "category",
+    "album_release_date": "category",
+}
+
+# columns added by `audio_features.main`
+FEATURED_SCHEMA = ENRICHED_SCHEMA | {
+    "danceability": "Float64",
+    "energy": "Float64",
+    "key": "Int64",
+    "loudness": "Float64",
+    "mode": "Int64",
+    "speechiness": "Float64",
+    "acousticness": "Float64",
+    "instrumentalness": "Float64",
+    "liveness": "Float64",
+    "valence": "Float64",
+    "tempo": "Float64",
+    "time_signature": "Int64",
+}
+
+# columns added by `metrics.main`
+METRICS_SCHEMA = FEATURED_SCHEMA | {
+    "year": "category",
+    "month": "category",
+    "month_name": "category",
+    "day": "category",
+    "day_of_week": "category",
+    "day_name": "category",
+    "hour": "category",
+    "minute": "category",
+    "min_played": "Float64",
+    "percentage_played": "Float64",
+    "is_new_track": "boolean",
+    "is_new_artist": "boolean",
+    "is_new_album": "boolean",
+    "normalized_platform": "category",
+    "skipped": "boolean",
+}
+
+
+def apply_schema(df: pd.DataFrame, schema: dict[str, str]) -> pd.DataFrame:
+    """
+    Cast the columns of `df` found in `schema`, unknown text columns become strings
+    A column that can not be cast is left untouched
+    """
+    dtypes = {column: schema.get(column, "string") for column in df.columns if column in schema or df[column].dtype == object}
+    for column, dtype in dtypes.items():
+        if df[column].dtype == dtype:
+            continue
+        try:
+            df[column] = df[column].astype(dtype)
+        except (TypeError, ValueError) as err:
+            logger.debug("column %s can not be cast to %s: %s", column, dtype, err)
+    return df
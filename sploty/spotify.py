@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from http import HTTPStatus
+from itertools import batched, islice
+from typing import Self
+
+import requests
+from pydantic import BaseModel, ConfigDict, HttpUrl, model_validator
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError
+
+from sploty import instrumentation
+from sploty.throttle import BatchTuner, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# a token is refreshed this number of seconds before it expires
+TOKEN_EXPIRY_MARGIN = 60
+# most ids accepted by a request of each batch endpoint
+MAX_BATCH_SIZES = {"tracks": 50, "audio-features": 100}
+
+
+class SpotifyClient:
+    """
+    Spotify Web API client shared by every stage and every worker
+    Requests go through a pooled keep-alive session, the client-credentials token is refreshed before it expires
+    and a request answered with a 401 is replayed once with a new token
+    pool_size: connections kept alive, at least the number of concurrent requests
+    """
+
+    def __init__(self, auth_url: str, client_id: str, client_secret: str, timeout: float, pool_size: int = 1) -> None:
+        self.auth_url = auth_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def token(self) -> str:
+        """Current access token, requested again when it is about to expire"""
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._expires_at - TOKEN_EXPIRY_MARGIN:
+                self._request_token()
+            return self._token
+
+    def refresh(self, stale_token: str):
+        """Request a new token, unless another worker already replaced `stale_token`"""
+        with self._lock:
+            if self._token == stale_token:
+                self._request_token()
+
+    def _request_token(self) -> None:
+        instrumentation.count("spotify.token.requests")
+        response = self.session.post(
+            self.auth_url,
+            {"grant_type": "client_credentials", "client_id": self.client_id, "client_secret": self.client_secret},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        token = response.json()
+        self._token = token["access_token"]
+        self._expires_at = time.monotonic() + token.get("expires_in", 3600)
+        logger.info("new Spotify token, valid for %is", token.get("expires_in", 3600))
+
+    def get(self, url: str, params=None, timeout: float | None = None) -> requests.Response:
+        token = self.token()
+        response = self.session.get(url, headers={"Authorization": f"Bearer {token}"}, params=params, timeout=timeout or self.timeout)
+        if response.status_code == HTTPStatus.UNAUTHORIZED:
+            logger.warning("HTTPError - %i %s (refreshing the token)", response.status_code, response.reason)
+            self.refresh(token)
+            response = self.session.get(url, headers={"Authorization": f"Bearer {self.token()}"}, params=params, timeout=timeout or self.timeout)
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+class SpotifyApiParams(BaseModel):
+    """
+    sleep: longest wait between two attempts, when the API does not give a `Retry-After`
+    throttle_retry: 429 in a row before giving up
+    batch_size: ids per request, the maximum of the endpoint by default
+    autotune: let a `BatchTuner` pick the batch size, up to `batch_size`
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    base_url: str
+    endpoint: str
+    url: HttpUrl
+    client: SpotifyClient
+    timeout: float
+    sleep: float
+    connection_error_retry: int = 5
+    throttle_retry: int = 10
+    concurrency: int = 1
+    limiter: TokenBucket | None = None
+    batch_size: int | None = None
+    autotune: bool = False
+    tuner: BatchTuner | None = None
+
+    @model_validator(mode="after")
+    def check_batch_size(self) -> Self:
+        max_batch_size = MAX_BATCH_SIZES.get(self.endpoint, 50)
+        if self.batch_size is None:
+            self.batch_size = max_batch_size
+        elif self.batch_size > max_batch_size:
+            logger.warning("%s accepts at most %i ids per request, not %i", self.endpoint, max_batch_size, self.batch_size)
+            self.batch_size = max_batch_size
+        if self.autotune and self.tuner is None:
+            self.tuner = BatchTuner(self.batch_size)
+        return self
+
+
+def retry_after(response, default: float) -> float:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+def backoff(attempt: int, longest: float) -> float:
+    """Exponential wait before the attempt `attempt` (from 0), capped to `longest` seconds"""
+    return min(longest, 2.0**attempt)
+
+
+def do_spotify_request(spotify_api_params: SpotifyApiParams, params=None):
+    endpoint = spotify_api_params.endpoint
+    limiter = spotify_api_params.limiter
+    throttled = 0
+    retry = 0
+    while True:
+        try:
+            if limiter:
+                limiter.acquire()
+            instrumentation.count(f"spotify.{endpoint}.requests")
+            with instrumentation.timed(f"spotify.{endpoint}.latency"):
+                response = spotify_api_params.client.get(str(spotify_api_params.url), params=params, timeout=spotify_api_params.timeout)
+            logger.debug(" -> %s", response.request.url)
+            logger.debug(" <- %i %s", response.status_code, response.text[:200].replace(" ", "").encode("UTF-8"))
+            response.raise_for_status()
+        except HTTPError as err:
+            if err.response.status_code != HTTPStatus.TOO_MANY_REQUESTS or throttled >= spotify_api_params.throttle_retry:
+                instrumentation.count(f"spotify.{endpoint}.errors")
+                logger.warning("HTTPError - %s (skipping)", err)
+                raise
+            instrumentation.count(f"spotify.{endpoint}.throttled")
+            sleep = retry_after(err.response, backoff(throttled, spotify_api_params.sleep))
+            throttled += 1
+            logger.warning("HTTPError - %s (sleeping %is...)", err, sleep)
+            if limiter:
+                limiter.throttled(sleep)
+            else:
+                time.sleep(sleep)
+        except ConnectionError as err:
+            if retry >= spotify_api_params.connection_error_retry:
+                instrumentation.count(f"spotify.{endpoint}.errors")
+                logger.warning("ConnectionError - %s (skipping)", err)
+                raise
+            instrumentation.count(f"spotify.{endpoint}.retries")
+            sleep = backoff(retry, spotify_api_params.sleep)
+            retry += 1
+            logger.warning(
+                "ConnectionError - %s (retry %i/%i sleeping %is...)",
+                err,
+                retry,
+                spotify_api_params.connection_error_retry,
+                sleep,
+            )
+            time.sleep(sleep)
+        else:
+            if limiter:
+                limiter.succeeded()
+            return response.json()
+
+
+def spotify_batches(spotify_api_params: SpotifyApiParams, ids: Iterable[str]) -> Iterator[tuple[str, ...]]:
+    """Batches of `ids` for one request each, sized by the tuner if there is one"""
+    if spotify_api_params.tuner is None:
+        yield from batched(ids, spotify_api_params.batch_size)
+        return
+    ids = iter(ids)
+    while batch := tuple(islice(ids, spotify_api_params.tuner.size())):
+        yield batch
+
+
+def get_many(spotify_api_params: SpotifyApiParams, ids: Iterable[str], key: str) -> list:
+    """Objects of a batch endpoint (`key` of the response), in the order of `ids`, None when an id is unknown"""
+    ids = list(ids)
+    params = [("ids", ",".join(ids)), ("type", "track"), ("market", "FR")]
+    start = time.perf_counter()
+    response = do_spotify_request(spotify_api_params, params=params)
+    if spotify_api_params.tuner is not None:
+        spotify_api_params.tuner.record(len(ids), time.perf_counter() - start)
+    return response[key]
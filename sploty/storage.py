@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pandas as pd
+
+from sploty import instrumentation
+from sploty.artifacts import StorageFormat, storage_format_of
+from sploty.schema import apply_schema
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+def artifact_size(path: str | Path) -> int:
+    """Bytes of an artifact, file or folder of parts"""
+    path = Path(path)
+    if path.is_dir():
+        return sum(part.stat().st_size for part in path.iterdir())
+    return path.stat().st_size if path.exists() else 0
+
+
+def categorical_dtypes(schema: dict[str, str] | None) -> dict[str, str] | None:
+    """Categorical columns of `schema`, the CSV parser builds them directly instead of a string per row"""
+    return {column: dtype for column, dtype in schema.items() if dtype == "category"} if schema else None
+
+
+def read_frame(path: str | Path, columns: list[str] | None = None, schema: dict[str, str] | None = None) -> pd.DataFrame:
+    """
+    Read a stage artifact, only `columns` if given
+    A parquet or feather artifact can be a folder of parts written by `append_frame`
+    """
+    path = Path(path)
+    match storage_format_of(path):
+        case StorageFormat.CSV:
+            df = pd.read_csv(path, usecols=columns, dtype=categorical_dtypes(schema))
+        case StorageFormat.PARQUET:
+            df = pd.read_parquet(path, columns=columns)
+        case StorageFormat.FEATHER if path.is_dir():
+            from pyarrow import dataset
+
+            df = dataset.dataset(path, format="feather").to_table(columns=columns).to_pandas()
+        case StorageFormat.FEATHER:
+            df = pd.read_feather(path, columns=columns)
+    instrumentation.count("storage.bytes_read", artifact_size(path))
+    return apply_schema(df, schema) if schema else df
+
+
+def iter_frame(path: str | Path, chunk_size: int, schema: dict[str, str] | None = None) -> Iterator[pd.DataFrame]:
+    """Read a stage artifact `chunk_size` rows at a time"""
+    path = Path(path)
+    instrumentation.count("storage.bytes_read", artifact_size(path))
+    match storage_format_of(path):
+        case StorageFormat.CSV:
+            chunks = pd.read_csv(path, chunksize=chunk_size, dtype=categorical_dtypes(schema))
+        case storage_format:
+            from pyarrow import dataset
+
+            batches = dataset.dataset(path, format=storage_format.value).to_batches(batch_size=chunk_size)
+            chunks = (batch.to_pandas() for batch in batches)
+    for chunk in chunks:
+        yield apply_schema(chunk, schema) if schema else chunk
+
+
+def without_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Categorical columns as strings, the parts of an artifact could not be read together with their own dictionaries
+    Parquet encodes them with a dictionary anyway, and the schema makes them categoricals again when they are read
+    """
+    categorical_columns = [column for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+    return df.astype(dict.fromkeys(categorical_columns, "string")) if categorical_columns else df
+
+
+def write_frame(df: pd.DataFrame, path: str | Path, schema: dict[str, str] | None = None) -> None:
+    """Write (or overwrite) a stage artifact"""
+    path = Path(path)
+    if schema:
+        df = apply_schema(df.copy(), schema)
+    delete_frame(path)
+    match storage_format_of(path):
+        case StorageFormat.CSV:
+            df.to_csv(path, mode="w", index=False)
+        case StorageFormat.PARQUET:
+            without_categories(df).to_parquet(path, index=False)
+        case StorageFormat.FEATHER:
+            without_categories(df).reset_index(drop=True).to_feather(path)
+    instrumentation.count("storage.bytes_written", artifact_size(path))
+
+
+def delete_frame(path: str | Path) -> None:
+    """Remove a stage artifact, file or folder of parts"""
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def append_frame(df: pd.DataFrame, path: str | Path, schema: dict[str, str] | None = None) -> None:
+    """
+    Append rows to a stage artifact
+    A parquet or feather artifact becomes a folder where each append writes a new part
+    """
+    path = Path(path)
+    if schema:
+        df = apply_schema(df.copy(), schema)
+    storage_format = storage_format_of(path)
+    if storage_format == StorageFormat.CSV:
+        size = artifact_size(path)
+        df.to_csv(path, mode="a", header=not path.exists(), index=False)
+        instrumentation.count("storage.bytes_written", artifact_size(path) - size)
+        return
+    if path.is_file():
+        # convert a single file artifact into the first part of the folder
+        first_part = path.read_bytes()
+        path.unlink()
+        path.mkdir()
+        (path / f"part-00000.{storage_format.value}").write_bytes(first_part)
+    path.mkdir(parents=True, exist_ok=True)
+    part_path = path / f"part-{len(list(path.iterdir())):05}.{storage_format.value}"
+    write_frame(df, part_path)
+
+
+def append_mark(path: str | Path) -> int:
+    """Position up to which an artifact is written: bytes of a CSV file, parts of a parquet or feather artifact"""
+    path = Path(path)
+    if not path.exists():
+        return 0
+    if storage_format_of(path) == StorageFormat.CSV:
+        return path.stat().st_size
+    return len(list(path.iterdir())) if path.is_dir() else 1
+
+
+def sync_frame(path: str | Path) -> None:
+    """Flush an artifact to the disk, its last part for a folder"""
+    path = Path(path)
+    if path.is_dir():
+        path = max(path.iterdir())
+    if path.exists():
+        with path.open("rb+") as file:
+            os.fsync(file.fileno())
+
+
+def rollback_frame(path: str | Path, mark: int) -> None:
+    """Remove what was appended to an artifact after `mark` (see `append_mark`)"""
+    path = Path(path)
+    if append_mark(path) <= mark:
+        return
+    logger.warning("rows appended to %s after the last commit are removed", path)
+    if mark == 0:
+        delete_frame(path)
+    elif storage_format_of(path) == StorageFormat.CSV:
+        with path.open("rb+") as file:
+            file.truncate(mark)
+    else:
+        for part_path in sorted(path.iterdir())[mark:]:
+            part_path.unlink()
+
+
+def month_of(end_time: pd.Series) -> pd.Series:
+    """Partition (year-month) of each stream, from its ISO `end_time`"""
+    return end_time.astype("string").str[:7]
+
+
+def partition_months(path: str | Path) -> list[str]:
+    """Months of the partitions of a partitioned artifact, in order"""
+    path = Path(path)
+    return sorted(partition_path.stem for partition_path in path.iterdir()) if path.is_dir() else []
+
+
+def read_partitions(
+    path: str | Path,
+    months: Iterable[str],
+    columns: list[str] | None = None,
+    schema: dict[str, str] | None = None,
+) -> pd.DataFrame:
+    """Read the partitions of `months` of a partitioned artifact, the other ones are never opened"""
+    partition_paths = {partition_path.stem: partition_path for partition_path in Path(path).glob("*")}
+    frames = [read_frame(partition_paths[month], columns, schema) for month in sorted(months) if month in partition_paths]
+    if not frames:
+        df = pd.DataFrame(columns=columns if columns is not None else list(schema or {}))
+        return apply_schema(df, schema) if schema else df
+    if len(frames) == 1:
+        return frames[0]
+    # the categories of the partitions differ, they are merged by casting the concatenated frame again
+    df = pd.concat(frames, ignore_index=True)
+    return apply_schema(df, schema) if schema else df
+
+
+def write_partitions(df: pd.DataFrame, path: str | Path, storage_format: StorageFormat, schema: dict[str, str] | None = None) -> list[str]:
+    """
+    Write (or overwrite) the partitions of the months of `df`, each one with the streams of its month
+    Return the written months
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    months = month_of(df["end_time"])
+    for month, positions in df.groupby(months, sort=True, observed=True).indices.items():
+        for previous_path in path.glob(f"{month}.*"):
+            delete_frame(previous_path)
+        write_frame(df.take(positions), path / f"{month}.{storage_format.value}", schema)
+    return sorted(months.dropna().unique())
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, TypeVar
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every worker hitting the same API
+    rate: tokens added per second
+    capacity: maximum burst of requests
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self):
+        """Block until a token is available and the bucket is not paused"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._resume_at:
+                    wait = self._resume_at - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (e.g. the `Retry-After` of a 429)"""
+        with self._lock:
+            self._pause(seconds)
+
+    def _pause(self, seconds: float) -> float:
+        """Return the number of seconds added to the current pause"""
+        now = time.monotonic()
+        added = max(0.0, now + seconds - max(self._resume_at, now))
+        self._resume_at = max(self._resume_at, now + seconds)
+        self._tokens = 0.0
+        self._updated_at = now
+        return added
+
+    def succeeded(self):
+        """Called after each successful request"""
+
+    def throttled(self, seconds: float):
+        """Called when the API answers with a 429, `seconds` being its `Retry-After`"""
+        self.pause(seconds)
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate follows the limit of the API (AIMD): each success adds `increase` requests per second
+    per second, each 429 multiplies the rate by `decrease` and pauses the bucket for the `Retry-After`
+    The 429 of a single burst only decrease the rate once, the rate stays between `min_rate` and `max_rate`
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        rate: float,
+        capacity: int = 1,
+        min_rate: float = 0.1,
+        max_rate: float | None = None,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+    ) -> None:
+        super().__init__(rate, capacity)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        # rate of the last 429, the observed limit of the API
+        self.limit = None
+        self.throttled_seconds = 0.0
+
+    def succeeded(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            rate = self.rate + self.increase / self.rate
+            self.rate = min(rate, self.max_rate) if self.max_rate is not None else rate
+
+    def throttled(self, seconds: float):
+        with self._lock:
+            if time.monotonic() >= self._resume_at:
+                self._refill(time.monotonic())
+                self.limit = self.rate
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                logger.info("throttled at %.1f requests/s, slowing down to %.1f requests/s", self.limit, self.rate)
+            self.throttled_seconds += self._pause(seconds)
+
+    def log_stats(self):
+        logger.info(
+            "rate of %.1f requests/s (limit %s), %.1fs throttled",
+            self.rate,
+            f"{self.limit:.1f} requests/s" if self.limit is not None else "never reached",
+            self.throttled_seconds,
+        )
+
+
+class BatchTuner:
+    """
+    Batch size giving the most items per second, under the current rate limit
+    Each candidate size is measured on `trials` requests, the best one is used for the next `explore_every` requests,
+    then the candidates are measured again as the limit can change during the run
+    """
+
+    def __init__(self, max_size: int, trials: int = 3, explore_every: int = 100) -> None:
+        self.candidates = sorted({max(1, max_size // 4), max(1, max_size // 2), max_size}, reverse=True)
+        self.trials = trials
+        self.explore_every = explore_every
+        self.best = max_size
+        self._measures = {size: [0, 0.0, 0] for size in self.candidates}
+        self._planned = 0
+        self._lock = threading.Lock()
+
+    def size(self) -> int:
+        """Size of the next batch"""
+        with self._lock:
+            cycle = len(self.candidates) * self.trials + self.explore_every
+            position = self._planned % cycle
+            self._planned += 1
+            if position == 0:
+                self._measures = {size: [0, 0.0, 0] for size in self.candidates}
+            if position < len(self.candidates) * self.trials:
+                return self.candidates[position // self.trials]
+            return self.best
+
+    def record(self, size: int, seconds: float):
+        """Measure a request of `size` ids which took `seconds`, waiting for the rate limit included"""
+        with self._lock:
+            if size not in self._measures:
+                return
+            measure = self._measures[size]
+            measure[0] += size
+            measure[1] += seconds
+            measure[2] += 1
+            throughputs = {
+                candidate: ids / total_seconds
+                for candidate, (ids, total_seconds, count) in self._measures.items()
+                if count >= self.trials and total_seconds > 0
+            }
+            if len(throughputs) == len(self.candidates):
+                best = max(throughputs, key=throughputs.get)
+                if best != self.best:
+                    logger.info("batches of %i ids (%.1f ids/s)", best, throughputs[best])
+                self.best = best
+
+
+def ordered_map(func: Callable[[T], R], items: Iterable[T], concurrency: int) -> Iterator[tuple[T, R]]:
+    """
+    Apply `func` to `items` in a thread pool and yield `(item, result)` in input order
+    At most `concurrency` calls are in flight, so an error stops the run quickly
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= concurrency:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
@@ -1,63 +1,187 @@
+from __future__ import annotations
+
 import json
 import logging
+from collections import Counter
+from pathlib import Path
+from typing import TYPE_CHECKING
 
+import numpy as np
 import pandas as pd
 from elasticsearch import Elasticsearch, helpers
+from pydantic import BaseModel
+
+from sploty import instrumentation
+from sploty.id_index import hash_ids
+from sploty.index_manifest import IndexManifest, hash_documents, reconcile
+from sploty.schema import METRICS_SCHEMA
+from sploty.storage import iter_frame
+from sploty.throttle import ordered_map
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
 
 logger = logging.getLogger(__name__)
 
+RENAMED_COLUMNS = {
+    "username": "stream_username",
+    "platform": "stream_platform",
+    "normalized_platform": "stream_normalized_platform",
+    "conn_country": "stream_conn_country",
+    "ip_addr_decrypted": "stream_ip_addr_decrypted",
+    "user_agent_decrypted": "stream_user_agent_decrypted",
+    "reason_start": "stream_reason_start",
+    "reason_end": "stream_reason_end",
+    "shuffle": "stream_shuffle",
+    "skipped": "stream_skipped",
+    "offline": "stream_offline",
+    "offline_timestamp": "stream_offline_timestamp",
+    "incognito_mode": "stream_incognito_mode",
+    "danceability": "track_audio_feature_danceability",
+    "energy": "track_audio_feature_energy",
+    "key": "track_audio_feature_key",
+    "loudness": "track_audio_feature_loudness",
+    "mode": "track_audio_feature_mode",
+    "speechiness": "track_audio_feature_speechiness",
+    "acousticness": "track_audio_feature_acousticness",
+    "instrumentalness": "track_audio_feature_instrumentalness",
+    "liveness": "track_audio_feature_liveness",
+    "valence": "track_audio_feature_valence",
+    "tempo": "track_audio_feature_tempo",
+    "time_signature": "track_audio_feature_time_signature",
+}
+
+
+class BulkParams(BaseModel):
+    """
+    chunk_size: documents per bulk request
+    max_chunk_bytes: maximum size of a bulk request
+    thread_count: bulk requests in flight
+    max_retries: retries of the documents rejected with a 429
+    initial_backoff: seconds before the first retry, doubled at each retry
+    dead_letter_path: file where write the documents that could not be indexed
+    manifest_path: file where keep the indexed documents, only new or changed documents are sent when it is given
+    reconcile: check the manifest against the ids of the index before sending documents
+    """
+
+    chunk_size: int = 500
+    max_chunk_bytes: int = 10 * 1024 * 1024
+    thread_count: int = 4
+    max_retries: int = 3
+    initial_backoff: float = 2
+    dead_letter_path: str | None = None
+    manifest_path: str | None = None
+    reconcile: bool = False
+
 
 def bulk_factory(df, index_name):
     for document in df:
         yield {"_index": index_name, "_id": document.pop("id"), "_source": document}
 
 
-def set_multidata(elastic, data, index_name):
-    logger.debug(" -> bulk %i documents", len(data))
-    response = helpers.bulk(elastic, bulk_factory(data, index_name), raise_on_error=False)
-    logger.debug(" <- bulk response is %s", response)
-
-
-def main(enriched_path: str, index_name: str, elastic):
-    # Read enriched streams
-    df_stream = pd.read_csv(enriched_path)
-
-    # Rename columns
-    df_stream = df_stream.rename(
-        columns={
-            "username": "stream_username",
-            "platform": "stream_platform",
-            "normalized_platform": "stream_normalized_platform",
-            "conn_country": "stream_conn_country",
-            "ip_addr_decrypted": "stream_ip_addr_decrypted",
-            "user_agent_decrypted": "stream_user_agent_decrypted",
-            "reason_start": "stream_reason_start",
-            "reason_end": "stream_reason_end",
-            "shuffle": "stream_shuffle",
-            "skipped": "stream_skipped",
-            "offline": "stream_offline",
-            "offline_timestamp": "stream_offline_timestamp",
-            "incognito_mode": "stream_incognito_mode",
-            "danceability": "track_audio_feature_danceability",
-            "energy": "track_audio_feature_energy",
-            "key": "track_audio_feature_key",
-            "loudness": "track_audio_feature_loudness",
-            "mode": "track_audio_feature_mode",
-            "speechiness": "track_audio_feature_speechiness",
-            "acousticness": "track_audio_feature_acousticness",
-            "instrumentalness": "track_audio_feature_instrumentalness",
-            "liveness": "track_audio_feature_liveness",
-            "valence": "track_audio_feature_valence",
-            "tempo": "track_audio_feature_tempo",
-            "time_signature": "track_audio_feature_time_signature",
-        },
-    )
-
-    # Index streams
+def iter_actions(chunks: Iterable[pd.DataFrame], index_name: str, manifest: IndexManifest | None = None) -> Iterator[tuple[list[dict], np.ndarray]]:
+    """
+    Bulk actions of each chunk of streams with the content hashes of their documents
+    Documents only exist for the chunks being indexed, and only new or changed ones are kept if a manifest is given
+    """
+    for df_chunk in chunks:
+        df_documents = df_chunk.rename(columns=RENAMED_COLUMNS)
+        contents = hash_documents(df_documents)
+        if manifest is not None:
+            changed = manifest.changed(hash_ids(df_documents["id"]), contents)
+            df_documents, contents = df_documents[changed], contents[changed]
+        if len(df_documents) > 0:
+            documents = json.loads(df_documents.to_json(orient="records"))
+            yield list(bulk_factory(documents, index_name)), contents
+
+
+def bulk_chunk(elastic, actions: list[dict], bulk_params: BulkParams) -> list[dict]:
+    """
+    Index a chunk of actions, the documents rejected with a 429 are retried with an exponential backoff
+    Return the documents that could not be indexed, with their error
+    """
+    sources = {action["_id"]: action["_source"] for action in actions}
+    failed = []
+    with instrumentation.timed("elastic.bulk.latency"):
+        for _, item in helpers.streaming_bulk(
+            elastic,
+            actions,
+            chunk_size=bulk_params.chunk_size,
+            max_chunk_bytes=bulk_params.max_chunk_bytes,
+            max_retries=bulk_params.max_retries,
+            initial_backoff=bulk_params.initial_backoff,
+            raise_on_error=False,
+            raise_on_exception=False,
+            yield_ok=False,
+        ):
+            _, info = item.popitem()
+            failed.append({"_id": info.get("_id"), "status": info.get("status"), "error": str(info.get("error")), "_source": sources.get(info.get("_id"))})
+    instrumentation.count("elastic.bulk.requests")
+    instrumentation.count("elastic.documents.sent", len(actions))
+    instrumentation.count("elastic.documents.failed", len(failed))
+    return failed
+
+
+def index_chunks(chunks: Iterable[pd.DataFrame], index_name: str, elastic, bulk_params: BulkParams) -> Counter:
+    """
+    Index chunks of streams with `thread_count` bulk requests in flight
+    A chunk is only read once a thread is free, so memory does not depend on the history length
+    Return the number of documents that could not be indexed by status
+    """
+    dead_letter_path = Path(bulk_params.dead_letter_path) if bulk_params.dead_letter_path is not None else None
+    if dead_letter_path is not None:
+        dead_letter_path.unlink(missing_ok=True)
+    manifest = IndexManifest.load(bulk_params.manifest_path) if bulk_params.manifest_path is not None else None
+    if manifest is not None and bulk_params.reconcile:
+        reconcile(manifest, elastic, index_name)
+
+    def index(batch: tuple[list[dict], np.ndarray]) -> list[dict]:
+        return bulk_chunk(elastic, batch[0], bulk_params)
+
+    number_of_documents, failed_statuses = 0, Counter()
+    indexed_ids, indexed_contents = [], []
+    for (actions, contents), failed in ordered_map(index, iter_actions(chunks, index_name, manifest), bulk_params.thread_count):
+        number_of_documents += len(actions)
+        failed_statuses.update(document["status"] for document in failed)
+        logger.debug(" <- %i documents indexed, %i failed", len(actions) - len(failed), len(failed))
+        if failed and dead_letter_path is not None:
+            with dead_letter_path.open("a", encoding="UTF-8") as file:
+                file.writelines(json.dumps(document) + "\n" for document in failed)
+        if manifest is not None:
+            failed_ids = {document["_id"] for document in failed}
+            is_indexed = np.array([action["_id"] not in failed_ids for action in actions], dtype=bool)
+            indexed_ids.append(hash_ids(pd.Series([action["_id"] for action in actions]))[is_indexed])
+            indexed_contents.append(contents[is_indexed])
+
+    number_of_failed = failed_statuses.total()
+    logger.info("%i documents indexed to %s", number_of_documents - number_of_failed, index_name)
+    if manifest is not None:
+        manifest.update(np.concatenate([np.array([], dtype=np.uint64), *indexed_ids]), np.concatenate([np.array([], dtype=np.uint64), *indexed_contents]))
+        manifest.save(bulk_params.manifest_path)
+    if number_of_failed:
+        logger.warning("%i documents could not be indexed (see %s)", number_of_failed, dead_letter_path)
+    return failed_statuses
+
+
+def iter_chunks(df_stream: pd.DataFrame, chunk_size: int) -> Iterator[pd.DataFrame]:
+    for start in range(0, len(df_stream), chunk_size):
+        yield df_stream.iloc[start : start + chunk_size]
+
+
+def index_streams(df_stream: pd.DataFrame, index_name: str, elastic, bulk_params: BulkParams | None = None):
+    bulk_params = bulk_params or BulkParams()
     logger.info("indexing %i tracks to %s", len(df_stream), index_name)
-    json_tmp = json.loads(df_stream.to_json(orient="records"))
-    logger.debug("%s", json_tmp[-1])
-    set_multidata(elastic, json_tmp, index_name)
+    index_chunks(iter_chunks(df_stream, bulk_params.chunk_size), index_name, elastic, bulk_params)
+
+
+def main(enriched_path: str, index_name: str, elastic, bulk_params: BulkParams | None = None):
+    """
+    enriched_path: file where read streams with their metrics, chunk by chunk
+    bulk_params: size and concurrency of the bulk requests
+    """
+    bulk_params = bulk_params or BulkParams()
+    logger.info("indexing %s to %s", enriched_path, index_name)
+    index_chunks(iter_frame(enriched_path, bulk_params.chunk_size, METRICS_SCHEMA), index_name, elastic, bulk_params)
 
 
 def get_elastic(hosts, username, password, timeout):
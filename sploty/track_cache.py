@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import time
+from itertools import batched
+from typing import TYPE_CHECKING
+
+from sploty import instrumentation
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# SQLite refuses more than 999 host parameters in old builds
+SQLITE_MAX_VARIABLES = 900
+
+
+class TrackCache:
+    """
+    On-disk track_uri -> Spotify track object cache shared across runs
+    It also remembers the ids an endpoint answered with null (negative cache), so they are not requested at each run
+    path: SQLite file to store tracks
+    ttl: seconds after which a cached track is fetched again, None to keep it forever
+    max_size: number of tracks kept, the oldest ones are evicted first, None for no limit
+    Expired and extra tracks are evicted when the cache is opened and closed, once per run rather than at each write
+    """
+
+    def __init__(self, path: str | Path, ttl: float | None = None, max_size: int | None = None) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS tracks (uri TEXT PRIMARY KEY, fetched_at REAL NOT NULL, data TEXT NOT NULL)",
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS tracks_fetched_at ON tracks (fetched_at)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS missing (endpoint TEXT NOT NULL, uri TEXT NOT NULL, fetched_at REAL NOT NULL, PRIMARY KEY (endpoint, uri))",
+        )
+        self.evict()
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def get_many(self, uris: Iterable[str]) -> dict[str, dict]:
+        """Return the fresh cached tracks among `uris`"""
+        uris = list(dict.fromkeys(uris))
+        oldest = time.time() - self.ttl if self.ttl is not None else float("-inf")
+        tracks = {}
+        for chunk in batched(uris, SQLITE_MAX_VARIABLES):
+            rows = self._connection.execute(
+                f"SELECT uri, data FROM tracks WHERE fetched_at >= ? AND uri IN ({','.join('?' * len(chunk))})",  # noqa: S608
+                (oldest, *chunk),
+            )
+            tracks.update((uri, json.loads(data)) for uri, data in rows)
+        return tracks
+
+    def get_known(self, uris: Iterable[str]) -> dict[str, dict | None]:
+        """Return the fresh cached tracks among `uris`, and None for the ones known as missing"""
+        uris = list(uris)
+        missing = self.get_missing("tracks", uris)
+        return dict.fromkeys(missing) | self.get_many(uri for uri in uris if uri not in missing)
+
+    def fresh_uris(self, uris: Iterable[str]) -> set[str]:
+        """Return the uris of `uris` whose track is cached and fresh"""
+        oldest = time.time() - self.ttl if self.ttl is not None else float("-inf")
+        fresh = set()
+        for chunk in batched(set(uris), SQLITE_MAX_VARIABLES):
+            rows = self._connection.execute(
+                f"SELECT uri FROM tracks WHERE fetched_at >= ? AND uri IN ({','.join('?' * len(chunk))})",  # noqa: S608
+                (oldest, *chunk),
+            )
+            fresh.update(row[0] for row in rows)
+        return fresh
+
+    def put_many(self, tracks: dict[str, dict]) -> None:
+        """Store `tracks` (track_uri -> track object), empty tracks are ignored"""
+        fetched_at = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO tracks (uri, fetched_at, data) VALUES (?, ?, ?)",
+                ((uri, fetched_at, json.dumps(track)) for uri, track in tracks.items() if track),
+            )
+
+    def get_missing(self, endpoint: str, uris: Iterable[str]) -> set[str]:
+        """Return the uris of `uris` that `endpoint` recently answered with null"""
+        oldest = time.time() - self.ttl if self.ttl is not None else float("-inf")
+        missing = set()
+        for chunk in batched(set(uris), SQLITE_MAX_VARIABLES):
+            rows = self._connection.execute(
+                f"SELECT uri FROM missing WHERE endpoint = ? AND fetched_at >= ? AND uri IN ({','.join('?' * len(chunk))})",  # noqa: S608
+                (endpoint, oldest, *chunk),
+            )
+            missing.update(row[0] for row in rows)
+        return missing
+
+    def put_missing(self, endpoint: str, uris: Iterable[str]) -> None:
+        """Remember that `endpoint` answered with null for `uris`"""
+        fetched_at = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO missing (endpoint, uri, fetched_at) VALUES (?, ?, ?)",
+                ((endpoint, uri, fetched_at) for uri in uris),
+            )
+
+    def evict(self) -> None:
+        """Drop expired tracks then the oldest ones above `max_size`"""
+        with self._connection:
+            if self.ttl is not None:
+                self._connection.execute("DELETE FROM tracks WHERE fetched_at < ?", (time.time() - self.ttl,))
+                self._connection.execute("DELETE FROM missing WHERE fetched_at < ?", (time.time() - self.ttl,))
+            if self.max_size is not None:
+                self._connection.execute(
+                    "DELETE FROM tracks WHERE uri IN (SELECT uri FROM tracks ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,),
+                )
+
+    def count_lookups(self, hits: int, misses: int) -> None:
+        """Count the tracks found in the cache and the ones to request, where it is decided to request them"""
+        self.hits += hits
+        self.misses += misses
+        instrumentation.count("track_cache.hits", hits)
+        instrumentation.count("track_cache.misses", misses)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def log_stats(self) -> None:
+        logger.info(
+            "track cache: %i hits, %i misses (%s hit rate), %i tracks stored",
+            self.hits,
+            self.misses,
+            f"{self.hit_rate:.1%}",
+            len(self),
+        )
+
+    def close(self) -> None:
+        self.evict()
+        self._connection.close()